@@ -1,3 +1,4 @@
+import functools
 import json
 import os
 import shutil
@@ -6,10 +7,18 @@ import time
 import aimrocks
 import matplotlib.pyplot as plt
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
-import tlsh
 
 import config
+import db_options
+import external_sort
+import fingerprints
+import instrumentation
+import keys
+import read_load
+import sweep
 
 querylog = False  # True to output queries to file, False to skip it
 make_charts = False  # True to create charts, False to skip it
@@ -28,102 +37,6 @@ metrics = ["compr_ratio", "ins_thr", "sg_thr", "mg_thr"]
 results = {}
 
 
-def create_tlsh(content) -> str:
-    if type(content) != str:
-        content = content.decode("latin-1")
-    fingerprint = "0"
-    # don't compute hash for strings bigger than 1 MiB (keep "0")
-    if len(content) > 1 * MiB:
-        return fingerprint
-    if len(content) > 50:  # requested by tlsh algorithm
-        # first 8 bytes are metadata
-        try:
-            fingerprint = tlsh.hash(str.encode(content))[8:]
-        except Exception as e:
-            print(f"ERROR IN CREATE_FINGERPRINTS: {e}")
-    return fingerprint
-
-
-def make_key(order, index_len, max_size, i, row):
-    key = ""
-    sha = str(row["hexsha"])
-    match order:
-        case "parquet":
-            index = str(i).zfill(index_len)
-            key = index + "-" + sha
-        case "rev-filename":
-            size_len = len(str(max_size))
-            size = str(row["size"]).zfill(size_len)
-            filename = str(row["filename"])
-            if filename is None:
-                filename = ""
-            key = filename[::-1] + "_" + size + "-" + sha
-        case "ext-filename":
-            size_len = len(str(max_size))
-            size = str(row["size"]).zfill(size_len)
-            filename = str(row["filename"])
-            if filename is None:
-                filename = ""
-            key = reverse_filename_tosoni(filename) + "_" + size + "-" + sha
-        case "ext-filename-nopath":
-            size_len = len(str(max_size))
-            size = str(row["size"]).zfill(size_len)
-            filename = str(row["filename"])
-            if filename is None:
-                filename = ""
-            key = reverse_filename_tosoni_nopath(filename) + "_" + size + "-" + sha
-        case "lang-ext-filename":
-            key = (
-                str(row["lang"])
-                + "-"
-                + reverse_filename_tosoni(str(row["filename"]))
-                + "-"
-                + sha
-            )
-        case "filename_repo":
-            key = str(row["filename"])[::-1] + "_" + str(row["repo"]) + "-" + sha
-        case "repo_filename":
-            key = str(row["repo"]) + "_" + str(row["filename"])[::-1] + "-" + sha
-        case "tlsh":
-            size_len = len(str(max_size))
-            size = str(row["size"]).zfill(size_len)
-            key = str(row["tlsh"]) + "_" + size + "-" + sha
-    return key
-
-
-def reverse_filename_tosoni(input_path: str):
-    if input_path is None:
-        return ""
-    # implement reversed string
-    # given path/to/file.cpp, return cpp.file/ot/htap
-    if "/" in input_path:
-        path, filename_with_extension = input_path.rsplit("/", 1)
-    else:
-        path, filename_with_extension = "", input_path
-    transformed_name = filename_with_extension
-    if "." in transformed_name:
-        filename, extension = filename_with_extension.rsplit(".", 1)
-        transformed_name = f"{extension}.{filename}"
-    reversed_path = path[::-1] if path else ""
-    if reversed_path:
-        transformed_path = f"{transformed_name}/{reversed_path}"
-    else:
-        transformed_path = f"{transformed_name}"
-
-    return transformed_path
-
-
-def reverse_filename_tosoni_nopath(input_path: str):
-    if input_path is None:
-        return ""
-    filename_with_extension = input_path.split("/")[-1]
-    transformed_name = filename_with_extension
-    if "." in transformed_name:
-        filename, extension = filename_with_extension.rsplit(".", 1)
-        transformed_name = f"{extension}.{filename}"
-    return transformed_name
-
-
 def get_compr_str(compr: tuple[aimrocks.CompressionType, int]):
     c_str = compr[0]
     if compr[0] != aimrocks.CompressionType.no_compression and compr[1] != 0:
@@ -135,10 +48,57 @@ def get_bs_str(bs: int):
     return str(round(bs / KiB)) + " KiB"
 
 
+def get_load_str(compr: tuple[aimrocks.CompressionType, int]):
+    return "same" if compr is None else get_compr_str(compr)
+
+
+def get_cache_str(size: int):
+    return "default" if size is None else str(round(size / MiB, 2))
+
+
+def get_test_id(cell: dict):
+    compr_str = get_compr_str(cell["compressor"])
+    ingest_mode = config.ingest_modes.get(cell["order"], "stream")
+    return f"{cell['block_size']},{compr_str},{cell['order']},{ingest_mode},{cell['insert_mode']},{cell['key_encoding']},{get_cache_str(cell['block_cache_size'])},{cell['bloom_bits']},{cell['dict_bytes']},{get_load_str(cell['load_compressor'])},{cell['write_path']}"
+
+
+def get_ledger_id(cell: dict):
+    # the test id and the settings shared by all the tests that change their
+    # results, so that a ledger row is reused only if none of them changed.
+    # The dataset is fingerprinted like the cached permutations are
+    stat = os.stat(config.parquet_path)
+    settings = (
+        f"{stat.st_size}-{stat.st_mtime_ns},"
+        f"{config.target_file_size},{config.full_compaction},{config.run_size},"
+        f"{n_queries},{readonly},{config.read_threads},{config.read_processes},"
+        f"{config.read_ops},{config.read_distribution},{config.read_zipf_s},"
+        f"{config.read_replay_path},{sorted(config.write_paths[cell['write_path']].items())}"
+    )
+    return f"{get_test_id(cell)},{settings}"
+
+
+def sample_keys(batch_keys, first: int, stride: int) -> pa.Array:
+    # the keys written at the positions multiple of `stride`, `first` being the
+    # position of batch_keys[0]. They are copied out, so the sample doesn't
+    # hold on to the whole batch
+    index = np.arange(-first % stride, len(batch_keys), stride)
+    sample = batch_keys.take(pa.array(index))
+    if isinstance(sample, pa.ChunkedArray):
+        sample = sample.combine_chunks()
+    return sample
+
+
 def test_rocksdb(
     compressor: tuple[aimrocks.CompressionType, int],
     order: str,
     block_size: int,
+    insert_mode: str,
+    key_encoding: str,
+    block_cache_size: int,
+    bloom_bits: int,
+    dict_bytes: int,
+    load_compressor: tuple[aimrocks.CompressionType, int],
+    write_path: str,
     table_len: int,
     index_len: int,
     max_size: int,
@@ -148,39 +108,58 @@ def test_rocksdb(
     # create the test db #
     ######################
     compr = compressor[0]
-    level = compressor[1]
-    db_test_path = f"{config.rocksdb_output_path}db_{str(compr)}_{str(block_size)}_{int(time.time())}"
-    opts = aimrocks.Options()
-    opts.create_if_missing = True
-    opts.error_if_exists = True
-    # options to make db faster
-    opts.allow_mmap_reads = True
-    opts.paranoid_checks = False
-    opts.use_adaptive_mutex = True
-    # options to try to make db smaller
-    # opts.compression_opts["max_dict_bytes"] = 1 * GiB
-    # compression and block
-    opts.compression = compr
-    if level != 0:
-        opts.compression_opts = {"level": level}
-        # opts.compression_opts["level"] = level
-    opts.table_factory = aimrocks.BlockBasedTableFactory(block_size=block_size)
+    # block cache and filter, shared by all the handles of the db
+    table = db_options.table_options(block_cache_size, bloom_bits)
+    # memtables, background jobs, WAL... of the inserts
+    write_profile = config.write_paths[write_path]
+    db_test_path = f"{config.rocksdb_output_path}db_{str(compr)}_{str(block_size)}_{order}_{insert_mode}_{key_encoding}_{get_cache_str(block_cache_size)}_{bloom_bits}_{dict_bytes}_{get_load_str(load_compressor)}_{write_path}_{os.getpid()}_{int(time.time())}"
+    # the data can be inserted with a faster compressor, see recompress below
+    opts = db_options.make_options(
+        load_compressor or compressor,
+        block_size,
+        insert_mode=insert_mode,
+        target_file_size=config.target_file_size,
+        table=table,
+        dict_bytes=dict_bytes,
+        write_path=write_profile,
+    )
     db_test = aimrocks.DB(db_test_path, opts, read_only=False)
 
     compr_str = get_compr_str(compressor)
     bs_str = get_bs_str(block_size)
-    print(f"{block_size/KiB},{compr_str},{order},", end="")
+    row = ""
+    metrics = {}
+    spans = instrumentation.Spans()
+    write_timer = instrumentation.Timer()
+    sg_timer = instrumentation.Timer(hist=True)
+    mg_timer = instrumentation.Timer(hist=True)
+    ingest_mode = config.ingest_modes.get(order, "stream")
+    row += f"{block_size/KiB},{compr_str},{order},{ingest_mode},{insert_mode},{key_encoding},"
+    row += f"{get_cache_str(block_cache_size)},{bloom_bits},{dict_bytes / KiB},"
+    row += f"{get_load_str(load_compressor)},{write_path},"
 
     #####################
     # build the test db #
     #####################
-    tot_insert_time = 0
+    # the peak memory of this test only, not of the tests before it
+    external_sort.reset_peak_rss()
+    start_rss = external_sort.rss()
+    start_ingest = time.perf_counter()
     ins_size = 0
+    spill_size = 0
     index_parq = 0
     query_log = []
     parquet_file = pq.ParquetFile(config.parquet_path)
+    # a sample of the keys for the read load, in the order they are written to
+    # the db: one key every `sample_stride`, about read_ops keys in all
+    sample_stride = -(-parquet_file.metadata.num_rows // max(config.read_ops, 1))
+    sampled_keys = []
+    n_written = 0
     batch_write = aimrocks.WriteBatch()
-    for batch in parquet_file.iter_batches(
+    if ingest_mode == "external-sort":
+        run_dir = f"{config.rocksdb_output_path}runs_{os.getpid()}_{int(time.time())}"
+        run_writer = external_sort.RunWriter(run_dir, config.run_size)
+    batches = parquet_file.iter_batches(
         columns=[
             "hexsha",
             "max_stars_repo_path",
@@ -189,37 +168,135 @@ def test_rocksdb(
             "size",
             "lang",
         ]
-    ):
-        batch = batch.rename_columns(
-            {
-                "hexsha": "hexsha",
-                "max_stars_repo_path": "filename",
-                # "max_stars_repo_name": "repo",
-                "content": "tlsh",
-                "size": "size",
-                "lang": "lang",
-            }
+    )
+    # fingerprints are only part of the key in the tlsh order
+    if order == "tlsh":
+        fp_cache = None
+        if config.fingerprint_cache_path is not None:
+            fp_cache = fingerprints.FingerprintCache(config.fingerprint_cache_path)
+        batches = fingerprints.iter_fingerprints(
+            batches, "content", config.fingerprint_workers, {}, fp_cache
         )
-        batch_list = batch.to_pylist()
-        for row in batch_list:
-            content = str(row["tlsh"])
-            cont_size = int(str(row["size"]))
-            row["tlsh"] = create_tlsh(content)
-            ins_size += cont_size
-            key = make_key(order, index_len, max_size, index_parq, row)
-            if index_parq in queries:
-                query_log.append(key)
-            index_parq += 1
-            batch_write.put(str.encode(key), str.encode(content))
-        start_write = time.time()
-        db_test.write(batch_write)
-        end_write = time.time()
-        tot_insert_time += end_write - start_write
-        batch_write.clear()
+    else:
+        batches = ((batch, None) for batch in batches)
+    with spans.span("insert"):
+        for batch, batch_tlsh in batches:
+            batch = batch.rename_columns(
+                {
+                    "hexsha": "hexsha",
+                    "max_stars_repo_path": "filename",
+                    # "max_stars_repo_name": "repo",
+                    "content": "content",
+                    "size": "size",
+                    "lang": "lang",
+                }
+            )
+            if batch_tlsh is not None:
+                batch = batch.append_column(
+                    "tlsh", pa.array(batch_tlsh, type=pa.string())
+                )
+            batch_keys = keys.build_keys(
+                batch, order, index_len, max_size, index_parq, key_encoding
+            )
+            batch_keys = pc.cast(batch_keys, pa.large_binary())
+            # log the keys of the rows that will be queried
+            batch_index = np.arange(index_parq, index_parq + batch.num_rows)
+            query_rows = np.flatnonzero(np.isin(batch_index, queries))
+            query_log += batch_keys.take(query_rows).to_pylist()
+            index_parq += batch.num_rows
+            ins_size += pc.sum(batch["size"]).as_py()
+            contents = pc.cast(batch["content"], pa.large_binary())
+            if ingest_mode == "external-sort":
+                run_writer.add(
+                    pa.record_batch([batch_keys, contents], names=["key", "value"])
+                )
+                continue
+            if config.read_threads > 0:
+                sampled_keys.append(sample_keys(batch_keys, n_written, sample_stride))
+            n_written += len(batch_keys)
+            for key, content in zip(batch_keys.to_pylist(), contents.to_pylist()):
+                batch_write.put(key, content)
+            with write_timer:
+                db_test.write(
+                    batch_write, **db_options.write_options(insert_mode, write_profile)
+                )
+            batch_write.clear()
+    # merge the sorted runs, the db receives the keys already in order
+    if ingest_mode == "external-sort":
+        with spans.span("external merge"):
+            run_paths = run_writer.finish()
+            spill_size = run_writer.spill_bytes
+            for merged in external_sort.merge_runs(run_paths, 10000):
+                if config.read_threads > 0:
+                    sampled_keys.append(
+                        sample_keys(merged["key"], n_written, sample_stride)
+                    )
+                n_written += merged.num_rows
+                merged_keys = merged["key"].to_pylist()
+                merged_contents = merged["value"].to_pylist()
+                for key, content in zip(merged_keys, merged_contents):
+                    batch_write.put(key, content)
+                with write_timer:
+                    db_test.write(
+                        batch_write,
+                        **db_options.write_options(insert_mode, write_profile),
+                    )
+                batch_write.clear()
+            shutil.rmtree(run_dir)
+    with spans.span("flush/compaction"), write_timer:
+        db_options.finish_insert(db_test, insert_mode, write_profile)
+    # wait for the background work (and compact all the db) before measuring
+    # it. This is timed too: every insert mode and write path is timed until
+    # its data is flushed and no compaction is left
+    with spans.span("settle"), write_timer:
+        db_options.settle(db_test, config.full_compaction)
+    settle_time = round(spans.seconds("settle"), 2)
+    end_ingest = time.perf_counter()
     # compute throughput
-    ins_thr = round(ins_size / MiB / tot_insert_time, 2)
-    results["ins_thr"][bs_str][compr_str] = ins_thr
-    print(f"{ins_thr},", end="")
+    ins_thr = round(ins_size / MiB / write_timer.seconds, 2)
+    e2e_thr = round(ins_size / MiB / (end_ingest - start_ingest), 2)
+    peak_rss = external_sort.peak_rss()
+    # the memory left by the tests before this one is in both, the growth is
+    # what the build needed (bounded by run_size with external-sort)
+    peak_rss_mb = round(peak_rss / MiB, 2)
+    build_rss_mb = round((peak_rss - start_rss) / MiB, 2)
+    metrics["ins_thr"] = ins_thr
+    row += f"{ins_thr},{e2e_thr},{peak_rss_mb},{build_rss_mb},"
+    row += f"{round(spill_size / MiB, 2)},"
+
+    # bytes written by the flushes and compactions for every byte of the
+    # settled SST files (1 when every byte is written once)
+    write_stats = db_options.compaction_stats(db_test)
+    written = write_stats["flush_bytes"] + write_stats["compaction_write_bytes"]
+    stored = sum(size for _, size in db_options.level_stats(db_test))
+    write_amp = round(written / stored, 2) if stored else 0
+    metrics["write_amp"] = write_amp
+    metrics["settle_time"] = settle_time
+    row += (
+        f"{settle_time},{round(write_stats['flush_bytes'] / MiB, 2)},"
+        f"{round(write_stats['compaction_read_bytes'] / MiB, 2)},"
+        f"{round(write_stats['compaction_write_bytes'] / MiB, 2)},{write_amp},"
+    )
+
+    # rewrite the files loaded with the load compressor with the final one
+    recompress_time = 0
+    if load_compressor is not None:
+        with spans.span("recompress"):
+            opts = db_options.make_options(
+                compressor,
+                block_size,
+                create=False,
+                insert_mode=insert_mode,
+                target_file_size=config.target_file_size,
+                table=table,
+                dict_bytes=dict_bytes,
+                write_path=write_profile,
+            )
+            del db_test
+            db_test = db_options.recompress(db_test_path, opts)
+        recompress_time = round(spans.seconds("recompress"), 2)
+    metrics["recompress_time"] = recompress_time
+    row += f"{recompress_time},"
 
     #########################################
     # measure db size and compression ratio #
@@ -227,38 +304,46 @@ def test_rocksdb(
     tot_db_size = 0
     tot_sst_size = 0
     tot_sst_files = 0
-    for dirpath, _, filenames in os.walk(db_test_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            try:
-                if not os.path.islink(fp):
-                    fsize = os.path.getsize(fp)
-                    tot_db_size += fsize
-                    if f.endswith(".sst"):
-                        tot_sst_size += fsize
-                        tot_sst_files += 1
-            except Exception as e:
-                print(e)
+    with spans.span("size measure"):
+        for dirpath, _, filenames in os.walk(db_test_path):
+            for f in filenames:
+                fp = os.path.join(dirpath, f)
+                try:
+                    if not os.path.islink(fp):
+                        fsize = os.path.getsize(fp)
+                        tot_db_size += fsize
+                        if f.endswith(".sst"):
+                            tot_sst_size += fsize
+                            tot_sst_files += 1
+                except Exception as e:
+                    print(e)
     compr_ratio = round((tot_db_size * 100) / parq_size_b, 2)
     avg_sst_size_mb = (
         round((tot_sst_size / MiB) / tot_sst_files, 2) if tot_sst_files != 0 else 0
     )
-    results["compr_ratio"][bs_str][compr_str] = compr_ratio
-    print(f"{compr_ratio},{avg_sst_size_mb},", end="")
+    metrics["compr_ratio"] = compr_ratio
+    row += f"{compr_ratio},{avg_sst_size_mb},"
+    # size of the index and filter blocks and of the keys, summed over the SST files
+    table_props = db_options.table_properties(db_test)
+    index_size_mb = round(db_options.index_block_size(table_props) / MiB, 3)
+    filter_size_mb = round(table_props.get("filter block size", 0) / MiB, 3)
+    avg_key_size = round(table_props.get("raw average key size", 0), 2)
+    metrics["index_size"] = index_size_mb
+    row += f"{index_size_mb},{filter_size_mb},{avg_key_size},"
+    # shape of the LSM tree and RocksDB estimates of the live data and keys
+    levels = db_options.level_stats(db_test)
+    live_data = int(db_test.get_property(b"rocksdb.estimate-live-data-size") or 0)
+    num_keys = int(db_test.get_property(b"rocksdb.estimate-num-keys") or 0)
+    row += f"{round(live_data / MiB, 2)},{num_keys},{db_options.levels_str(levels)},"
 
     ### Close the DB and reopen it
     if readonly:
-        db_test.close()
-        opts = aimrocks.Options()
-        opts.create_if_missing = False
-        opts.error_if_exists = False
-        opts.allow_mmap_reads = True
-        opts.paranoid_checks = False
-        opts.use_adaptive_mutex = True
-        opts.compression = compr
-        if level != 0:
-            opts.compression_opts = {"level": level}
-        opts.table_factory = aimrocks.BlockBasedTableFactory(block_size=block_size)
+        # drop the handle rather than close() it: an aimrocks DB closed by
+        # hand crashes when it is garbage collected
+        del db_test
+        opts = db_options.make_options(
+            compressor, block_size, create=False, table=table
+        )
         db_test_read = aimrocks.DB(db_test_path, opts, read_only=True)
     else:
         db_test_read = db_test
@@ -271,41 +356,104 @@ def test_rocksdb(
     got_size = 0
     ind_query = 0
     keys_mget = []
-    tot_sg_time = 0
-    tot_mg_time = 0
     n_mget = 0
-    for i, key in enumerate(query_log):
-        keys_mget.append(str.encode(key))
-        # test single get
-        start_sg_time = time.time()
-        got = db_test.get(str.encode(key))
-        end_sg_time = time.time()
-        tot_sg_time += end_sg_time - start_sg_time
-        got_size += len(got)
-        found_sg += sum(x is not None for x in [got])
-        ind_query += 1
-        # test multi get
-        if ind_query % 100 == 0 or (i == table_len - 1 and len(keys_mget) > 0):
-            start_mg_time = time.time()
-            gotlist = db_test.multi_get(keys_mget)
-            end_mg_time = time.time()
-            keys_mget.clear()
-            n_mget += 1
-            tot_mg_time += end_mg_time - start_mg_time
-            found_mg += sum(x is not None for x in gotlist)
+    with spans.span("query"):
+        for i, key in enumerate(query_log):
+            keys_mget.append(key)
+            # test single get
+            start_sg_time = time.perf_counter_ns()
+            got = db_test_read.get(key)
+            sg_timer.add(time.perf_counter_ns() - start_sg_time)
+            got_size += len(got)
+            found_sg += sum(x is not None for x in [got])
+            ind_query += 1
+            # test multi get
+            if ind_query % 100 == 0 or (i == table_len - 1 and len(keys_mget) > 0):
+                start_mg_time = time.perf_counter_ns()
+                gotlist = db_test_read.multi_get(keys_mget)
+                mg_timer.add(time.perf_counter_ns() - start_mg_time)
+                keys_mget.clear()
+                n_mget += 1
+                found_mg += sum(x is not None for x in gotlist.values())
     if found_sg != len(queries):
-        print(f"\nERROR: found {found_sg} out of {len(queries)} queries")
+        print(f"ERROR: found {found_sg} out of {len(queries)} queries")
     if not (found_sg == found_mg):
-        print(f"\nERROR: found numbers differ: {found_sg}, {found_mg}")
+        print(f"ERROR: found numbers differ: {found_sg}, {found_mg}")
     # compute times
-    sg_thr = (got_size / MiB) / tot_sg_time
-    mg_thr = (got_size / MiB) / tot_mg_time
-    results["sg_thr"][bs_str][compr_str] = round(sg_thr, 2)
-    results["mg_thr"][bs_str][compr_str] = round(mg_thr, 2)
-    print(f"{round(sg_thr, 2)},{round(mg_thr, 2)}")
+    sg_thr = (got_size / MiB) / sg_timer.seconds
+    mg_thr = (got_size / MiB) / mg_timer.seconds
+    metrics["sg_thr"] = round(sg_thr, 2)
+    metrics["mg_thr"] = round(mg_thr, 2)
+    metrics["sg_p50"] = round(sg_timer.hist.percentile(50) / 1000, 2)
+    row += f"{round(sg_thr, 2)},{round(mg_thr, 2)},"
+    # what the queries left in the block cache
+    cache_usage, cache_pinned = db_options.block_cache_usage(db_test_read)
+    row += f"{round(cache_usage / MiB, 2)},{round(cache_pinned / MiB, 2)},"
+
+    ######################
+    # concurrent readers #
+    ######################
+    read_result = None
+    if config.read_threads > 0:
+        with spans.span("read load"):
+            # a sample of the keys in the db, in insertion order
+            workload = read_load.make_workload(
+                pa.concat_arrays(sampled_keys),
+                config.read_distribution,
+                config.read_ops,
+                config.read_zipf_s,
+                config.read_replay_path,
+                hex_keys=key_encoding == "binary",
+            )
+            open_db = functools.partial(
+                aimrocks.DB,
+                db_test_path,
+                db_options.make_options(
+                    compressor, block_size, create=False, table=table
+                ),
+                read_only=True,
+            )
+            read_result = read_load.run(
+                db_test_read,
+                workload,
+                config.read_threads,
+                config.read_processes,
+                open_db,
+            )
+            if config.read_distribution != "replay" and read_result["found"] != len(
+                workload
+            ):
+                print(
+                    f"ERROR: read load found {read_result['found']} of {len(workload)}"
+                )
+    row += read_load.csv_fields(
+        config.read_distribution,
+        config.read_threads,
+        config.read_processes,
+        read_result,
+    )
+    metrics["instrumentation"] = instrumentation.to_json(
+        {
+            "phases": spans,
+            "timers": {
+                "write": write_timer,
+                "single_get": sg_timer,
+                "multi_get": mg_timer,
+            },
+            "read_load": read_result,
+            "compaction": write_stats,
+            "levels": levels,
+        }
+    )
     # print the query log to file
     if querylog:
-        with open(f"query_log-{PID}/{compr_str}_{bs_str}_{order}.json", "w") as f:
+        # binary keys are logged in hexadecimal
+        query_log = [
+            key.decode() if key_encoding == "text" else key.hex() for key in query_log
+        ]
+        with open(
+            f"query_log-{PID}/{compr_str}_{bs_str}_{order}_{key_encoding}.json", "w"
+        ) as f:
             f.write(json.dumps(query_log, indent=4))
 
     #################
@@ -316,6 +464,8 @@ def test_rocksdb(
         if os.path.exists(db_test_path):
             shutil.rmtree(db_test_path)
 
+    return row, metrics
+
 
 if __name__ == "__main__":
     print(f"Start computation at {time.asctime()}")
@@ -325,11 +475,35 @@ if __name__ == "__main__":
     print(f"Putting temp RocksDBs in {config.rocksdb_output_path}")
     print(f"Dataset {config.parquet_path}, size {round(parq_size_b / MiB, 3)} MiB")
     print(f"Number of queries: {n_queries}")
+    print(f"Fingerprint cache: {config.fingerprint_cache_path}")
+    print(
+        f"Ingest modes: {config.ingest_modes}, run size {round(config.run_size / MiB)} MiB"
+    )
     print()
 
     print(f"Orderings: {config.orders}")
     print(f"Compressors: {[get_compr_str(c) for c in config.compressors]}")
     print(f"Block sizes: {[get_bs_str(b) for b in config.block_sizes]}")
+    print(f"Insert modes: {config.insert_modes}")
+    print(f"Full compaction before measuring: {config.full_compaction}")
+    print(f"Key encodings: {config.key_encodings}")
+    print(f"Block caches (MiB): {[get_cache_str(c) for c in config.block_cache_sizes]}")
+    print(f"Bloom filter bits per key: {config.bloom_bits}")
+    print(f"Dictionary sizes (KiB): {[d / KiB for d in config.dict_bytes]}")
+    print(f"Load compressors: {[get_load_str(c) for c in config.load_compressors]}")
+    print(f"Write paths: {list(config.write_paths)}")
+    n_workers = sweep.max_workers(
+        config.sweep_workers,
+        config.rocksdb_output_path,
+        config.sweep_disk_per_test,
+        config.sweep_mem_per_test,
+    )
+    print(f"Parallel tests: {n_workers}")
+    print(
+        f"Read load: {config.read_ops} {config.read_distribution} reads, "
+        f"{config.read_processes} processes x {config.read_threads} threads"
+    )
+    print(f"Results ledger: {config.results_ledger_dir}")
     print()
 
     # setup histogram results dictionary
@@ -346,14 +520,12 @@ if __name__ == "__main__":
     x_blocksizes = list(results["compr_ratio"].keys())
 
     # get max_size and max_index
-    table = pq.read_table(config.parquet_path, columns=["size"])
+    run_spans = instrumentation.Spans()
+    with run_spans.span("read sizes"):
+        table = pq.read_table(config.parquet_path, columns=["size"])
     table_len = table.num_rows
     index_len = len(str(table_len))
-    max_size = 0
-    for i in table["size"]:
-        size = i.as_py()
-        if size > max_size:
-            max_size = size
+    max_size = pc.max(table["size"]).as_py()
 
     # create query log directory
     if querylog:
@@ -364,25 +536,129 @@ if __name__ == "__main__":
         n_queries = table_len
     queries = list(np.random.permutation(table_len)[:n_queries])
 
-    print(
-        "BLOCK_SIZE(KiB),COMPRESSION,ORDER,INSERT_THROUGHPUT(MiB/s),COMPRESSION_RATIO(%),AVG_SST_FILE_SIZE(MiB),SINGLE_GET_THROUGHPUT(MiB/s),MULTI_GET_THROUGHPUT(MiB/S)"
+    header = "BLOCK_SIZE(KiB),COMPRESSION,ORDER,INGEST_MODE,INSERT_MODE,KEY_ENCODING,BLOCK_CACHE(MiB),BLOOM_BITS,DICT_SIZE(KiB),LOAD_COMPRESSION,WRITE_PATH,INSERT_THROUGHPUT(MiB/s),END_TO_END_THROUGHPUT(MiB/s),PEAK_RSS(MiB),BUILD_RSS(MiB),SPILL_SIZE(MiB),SETTLE_TIME(s),FLUSH_WRITE(MiB),COMPACTION_READ(MiB),COMPACTION_WRITE(MiB),WRITE_AMP,RECOMPRESS_TIME(s),COMPRESSION_RATIO(%),AVG_SST_FILE_SIZE(MiB),INDEX_SIZE(MiB),FILTER_SIZE(MiB),AVG_KEY_SIZE(B),LIVE_DATA(MiB),NUM_KEYS,LEVELS,SINGLE_GET_THROUGHPUT(MiB/s),MULTI_GET_THROUGHPUT(MiB/S),BLOCK_CACHE_USAGE(MiB),BLOCK_CACHE_PINNED(MiB),"
+    header += read_load.CSV_HEADER
+    print(header)
+    # run tests, every configuration of the grid is independent
+    cells = [
+        {
+            "compressor": compr,
+            "order": order,
+            "block_size": block_size,
+            "insert_mode": insert_mode,
+            "key_encoding": key_encoding,
+            "block_cache_size": block_cache_size,
+            "bloom_bits": bits,
+            "dict_bytes": dict_bytes,
+            "load_compressor": load_compr,
+            "write_path": write_path,
+        }
+        for block_size in config.block_sizes
+        for compr in config.compressors
+        for order in config.orders
+        for insert_mode in config.insert_modes
+        for key_encoding in config.key_encodings
+        for block_cache_size in config.block_cache_sizes
+        for bits in config.bloom_bits
+        for dict_bytes in config.dict_bytes
+        for load_compr in config.load_compressors
+        for write_path in config.write_paths
+    ]
+    test = functools.partial(
+        test_rocksdb,
+        table_len=table_len,
+        index_len=index_len,
+        max_size=max_size,
+        queries=queries,
     )
-    # run tests
-    for block_size in config.block_sizes:
-        for compr in config.compressors:
-            test_orders = config.orders
-            for order in test_orders:
-                test_rocksdb(
-                    compressor=compr,
-                    order=order,
-                    block_size=block_size,
-                    table_len=table_len,
-                    index_len=index_len,
-                    max_size=max_size,
-                    queries=queries,
-                )
+    # tests already in the ledger of a previous run are not repeated
+    ledger = None
+    if config.results_ledger_dir is not None:
+        dataset = os.path.splitext(os.path.basename(config.parquet_path))[0]
+        ledger = sweep.Ledger(
+            f"{config.results_ledger_dir}ledger-not_sorted-{dataset}.csv", header
+        )
+
+    test_results = sweep.run_ledger(test, cells, n_workers, ledger, get_ledger_id)
+    tests_instrumentation = []
+    tests_metrics = []
+    for cell, (row, test_metrics) in zip(cells, test_results):
+        print(row)
+        tests_metrics.append(test_metrics)
+        tests_instrumentation.append(
+            {"test": get_test_id(cell), **test_metrics.get("instrumentation", {})}
+        )
+        bs_str = get_bs_str(cell["block_size"])
+        compr_str = get_compr_str(cell["compressor"])
+        for m in metrics:
+            results[m][bs_str][compr_str] = test_metrics[m]
     print()
 
+    # change given by the compression dictionaries, against no dictionary
+    dict_deltas = sweep.baseline_deltas(
+        cells, tests_metrics, "dict_bytes", 0, ["compr_ratio", "sg_p50", "sg_thr"]
+    )
+    if dict_deltas:
+        print(
+            "TEST,DICT_SIZE(KiB),COMPRESSION_RATIO_CHANGE(%),SINGLE_GET_P50_CHANGE(%),SINGLE_GET_THROUGHPUT_CHANGE(%)"
+        )
+        for cell, delta in dict_deltas:
+            print(
+                f"{get_test_id(cell)},{cell['dict_bytes'] / KiB},{delta['compr_ratio']},"
+                f"{delta['sg_p50']},{delta['sg_thr']}"
+            )
+        print()
+
+    # insert throughput of every write path, against the first one
+    path_deltas = sweep.baseline_deltas(
+        cells,
+        tests_metrics,
+        "write_path",
+        next(iter(config.write_paths)),
+        ["ins_thr", "write_amp"],
+    )
+    if path_deltas:
+        print("TEST,WRITE_PATH,INSERT_THROUGHPUT_CHANGE(%),WRITE_AMP_CHANGE(%)")
+        for cell, delta in path_deltas:
+            print(
+                f"{get_test_id(cell)},{cell['write_path']},{delta['ins_thr']},"
+                f"{delta['write_amp']}"
+            )
+        print()
+        # fastest write path of every order, with the time it waited for
+        # the compactions it left behind (part of its insert throughput)
+        print("ORDER,WRITE_PATH,INSERT_THROUGHPUT(MiB/s),SETTLE_TIME(s),WRITE_AMP")
+        for order in config.orders:
+            cell, m = max(
+                (
+                    (cell, m)
+                    for cell, m in zip(cells, tests_metrics)
+                    if cell["order"] == order
+                ),
+                key=lambda cell_m: cell_m[1]["ins_thr"],
+            )
+            print(
+                f"{order},{cell['write_path']},{m['ins_thr']},"
+                f"{m['settle_time']},{m['write_amp']}"
+            )
+        print()
+
+    # export the timings of the run and of every test next to the results
+    if config.instrumentation_dir is not None:
+        dataset = os.path.splitext(os.path.basename(config.parquet_path))[0]
+        instr_path = f"{config.instrumentation_dir}instrumentation-not_sorted-{dataset}-{PID}.json"
+        instrumentation.export_json(
+            instr_path,
+            {
+                "benchmark": "not_sorted",
+                "dataset": config.parquet_path,
+                "phases": run_spans,
+                "tests": tests_instrumentation,
+            },
+        )
+        print(f"Timings exported to {instr_path}")
+        print()
+
     # create histograms for the results
     if make_charts:
         charts_dir = f"charts_benchmark-{PID}"
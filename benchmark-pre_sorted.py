@@ -1,5 +1,5 @@
+import functools
 import json
-import mmap
 import os
 import shutil
 import time
@@ -7,16 +7,25 @@ import time
 import aimrocks
 import matplotlib.pyplot as plt
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
-import tlsh
 
 import config
+import contents_store
+import db_options
+import fingerprints
+import instrumentation
+import keys
+import read_load
+import sweep
 
 querylog = False  # True to output queries to file, False to skip it
 make_charts = False  # True to create charts, False to skip it
 keep_db = False  # True to delete the test dbs, False to skip it
 readonly = False  # True to close db and reopen in readonly, False to skip it
 n_queries = 10000  # number of queries to make on the dbs to test their throughput
+prefetch_contents = True  # True to madvise the contents ahead of insertion
 
 parq_size_b = os.path.getsize(config.parquet_path)
 
@@ -29,69 +38,6 @@ metrics = ["compr_ratio", "ins_thr", "sg_thr", "mg_thr"]
 results = {}
 
 
-def create_tlsh(content) -> str:
-    if type(content) != str:
-        content = content.decode("latin-1")
-    fingerprint = "0"
-    # don't compute hash for strings bigger than 1 MiB (keep "0")
-    if len(content) > 1 * MiB:
-        return fingerprint
-    if len(content) > 50:  # requested by tlsh algorithm
-        # first 8 bytes are metadata
-        try:
-            fingerprint = tlsh.hash(str.encode(content))[8:]
-        except Exception as e:
-            print(f"ERROR IN CREATE_FINGERPRINTS: {e}")
-    return fingerprint
-
-
-def make_key(order, index_len, max_size, i, row):
-    key = ""
-    sha = str(row["hexsha"])
-    match order:
-        case "parquet":
-            index = str(i).zfill(index_len)
-            key = index + "-" + sha
-        case "rev-filename":
-            size_len = len(str(max_size))
-            size = str(row["size"]).zfill(size_len)
-            filename = str(row["filename"])
-            if filename is None:
-                filename = ""
-            key = filename[::-1] + "_" + size + "-" + sha
-        case "ext-filename":
-            size_len = len(str(max_size))
-            size = str(row["size"]).zfill(size_len)
-            filename = str(row["filename"])
-            if filename is None:
-                filename = ""
-            key = reverse_filename_tosoni(filename) + "_" + size + "-" + sha
-        case "ext-filename-nopath":
-            size_len = len(str(max_size))
-            size = str(row["size"]).zfill(size_len)
-            filename = str(row["filename"])
-            if filename is None:
-                filename = ""
-            key = reverse_filename_tosoni_nopath(filename) + "_" + size + "-" + sha
-        case "lang-ext-filename":
-            key = (
-                str(row["lang"])
-                + "-"
-                + reverse_filename_tosoni(str(row["filename"]))
-                + "-"
-                + sha
-            )
-        case "filename_repo":
-            key = str(row["filename"])[::-1] + "_" + str(row["repo"]) + "-" + sha
-        case "repo_filename":
-            key = str(row["repo"]) + "_" + str(row["filename"])[::-1] + "-" + sha
-        case "tlsh":
-            size_len = len(str(max_size))
-            size = str(row["size"]).zfill(size_len)
-            key = str(row["tlsh"]) + "_" + size + "-" + sha
-    return key
-
-
 def get_compr_str(compr: tuple[aimrocks.CompressionType, int]):
     c_str = compr[0]
     if compr[0] != aimrocks.CompressionType.no_compression and compr[1] != 0:
@@ -103,99 +49,60 @@ def get_bs_str(bs: int):
     return str(round(bs / KiB)) + " KiB"
 
 
-def reverse_filename_tosoni_nopath(input_path: str):
-    if input_path is None:
-        return ""
-    filename_with_extension = input_path.split("/")[-1]
-    transformed_name = filename_with_extension
-    if "." in transformed_name:
-        filename, extension = filename_with_extension.rsplit(".", 1)
-        transformed_name = f"{extension}.{filename}"
-    return transformed_name
-
-
-def reverse_filename_tosoni(input_path: str):
-    if input_path is None:
-        return ""
-    # implement reversed string
-    # given path/to/file.cpp, return cpp.file/ot/htap
-    if "/" in input_path:
-        path, filename_with_extension = input_path.rsplit("/", 1)
-    else:
-        path, filename_with_extension = "", input_path
-    transformed_name = filename_with_extension
-    if "." in transformed_name:
-        filename, extension = filename_with_extension.rsplit(".", 1)
-        transformed_name = f"{extension}.{filename}"
-    reversed_path = path[::-1] if path else ""
-    if reversed_path:
-        transformed_path = f"{transformed_name}/{reversed_path}"
-    else:
-        transformed_path = f"{transformed_name}"
+def get_load_str(compr: tuple[aimrocks.CompressionType, int]):
+    return "same" if compr is None else get_compr_str(compr)
 
-    return transformed_path
 
+def get_cache_str(size: int):
+    return "default" if size is None else str(round(size / MiB, 2))
+
+
+def permutation_path(order: str, key_encoding: str):
+    if config.permutation_cache_dir is None:
+        return None
+    dataset = os.path.splitext(os.path.basename(config.parquet_path))[0]
+    if key_encoding != "text":
+        order = f"{order}-{key_encoding}"
+    # a new version of the dataset gets new permutations
+    stat = os.stat(config.parquet_path)
+    version = f"{stat.st_size}-{stat.st_mtime_ns}"
+    return f"{config.permutation_cache_dir}{dataset}-{version}-{order}-permutation.npy"
+
+
+def get_test_id(cell: dict):
+    compr_str = get_compr_str(cell["compressor"])
+    return f"{cell['block_size']},{compr_str},{cell['order']},{cell['insert_mode']},{cell['key_encoding']},{get_cache_str(cell['block_cache_size'])},{cell['bloom_bits']},{cell['dict_bytes']},{get_load_str(cell['load_compressor'])},{cell['write_path']}"
 
-def sort_df(data: list[dict], order: str):
-    sorted_data = data[:]
-    if order != "parquet":
-        match order:
-            case "rev-filename":
-                sorted_data.sort(
-                    key=lambda x: (
-                        x["filename"][::-1] if x["filename"] != None else "",
-                        -x["size"],
-                    )
-                )
-            case "ext-filename":
-                sorted_data.sort(
-                    key=lambda x: (
-                        (
-                            reverse_filename_tosoni(x["filename"])
-                            if x["filename"] != None
-                            else ""
-                        ),
-                        -x["size"],
-                    )
-                )
-            case "ext-filename-nopath":
-                sorted_data.sort(
-                    key=lambda x: (
-                        (
-                            reverse_filename_tosoni_nopath(x["filename"])
-                            if x["filename"] != None
-                            else ""
-                        ),
-                        -x["size"],
-                    ),
-                )
-            case "lang-ext-filename":
-                sorted_data.sort(
-                    key=lambda x: (
-                        x["lang"],
-                        (
-                            reverse_filename_tosoni(x["filename"])
-                            if x["filename"] != None
-                            else ""
-                        ),
-                    )
-                )
-            case "filename_repo":
-                sorted_data.sort(key=lambda x: (x["filename"][::-1], x["repo"]))
-            case "repo_filename":
-                sorted_data.sort(key=lambda x: (x["repo"], x["filename"][::-1]))
-            case "tlsh":
-                sorted_data.sort(key=lambda x: (x["tlsh"], -x["size"]))
-    return sorted_data
+
+def get_ledger_id(cell: dict):
+    # the test id and the settings shared by all the tests that change their
+    # results, so that a ledger row is reused only if none of them changed.
+    # The dataset is fingerprinted like the cached permutations are
+    stat = os.stat(config.parquet_path)
+    settings = (
+        f"{stat.st_size}-{stat.st_mtime_ns},"
+        f"{config.target_file_size},{config.full_compaction},{prefetch_contents},"
+        f"{n_queries},{readonly},{config.read_threads},{config.read_processes},"
+        f"{config.read_ops},{config.read_distribution},{config.read_zipf_s},"
+        f"{config.read_replay_path},{sorted(config.write_paths[cell['write_path']].items())}"
+    )
+    return f"{get_test_id(cell)},{settings}"
 
 
 def test_rocksdb(
-    txt_mmap: mmap,
-    txt_index: dict[str, dict],
-    metadata_list: list[dict],
+    txt_contents: contents_store.ContentsFile,
+    txt_index: contents_store.ContentsIndex,
+    metadata: pa.Table,
     compressor: tuple[aimrocks.CompressionType, int],
     order: str,
     block_size: int,
+    insert_mode: str,
+    key_encoding: str,
+    block_cache_size: int,
+    bloom_bits: int,
+    dict_bytes: int,
+    load_compressor: tuple[aimrocks.CompressionType, int],
+    write_path: str,
     max_size: int,
     queries: list[int],
 ):
@@ -203,67 +110,134 @@ def test_rocksdb(
     # create the test db #
     ######################
     compr = compressor[0]
-    level = compressor[1]
-    db_test_path = f"{config.rocksdb_output_path}db_{str(compr)}_{str(block_size)}_{int(time.time())}"
-    opts = aimrocks.Options()
-    opts.create_if_missing = True
-    opts.error_if_exists = True
-    # options to make db faster
-    opts.allow_mmap_reads = True
-    opts.paranoid_checks = False
-    opts.use_adaptive_mutex = True
-    # compression and block
-    opts.compression = compr
-    if level != 0:
-        opts.compression_opts = {"level": level}
-        # opts.compression_opts["level"] = level
-    opts.table_factory = aimrocks.BlockBasedTableFactory(block_size=block_size)
+    # block cache and filter, shared by all the handles of the db
+    table = db_options.table_options(block_cache_size, bloom_bits)
+    # memtables, background jobs, WAL... of the inserts
+    write_profile = config.write_paths[write_path]
+    db_test_path = f"{config.rocksdb_output_path}db_{str(compr)}_{str(block_size)}_{order}_{insert_mode}_{key_encoding}_{get_cache_str(block_cache_size)}_{bloom_bits}_{dict_bytes}_{get_load_str(load_compressor)}_{write_path}_{os.getpid()}_{int(time.time())}"
+    # the data can be inserted with a faster compressor, see recompress below
+    opts = db_options.make_options(
+        load_compressor or compressor,
+        block_size,
+        insert_mode=insert_mode,
+        target_file_size=config.target_file_size,
+        table=table,
+        dict_bytes=dict_bytes,
+        write_path=write_profile,
+    )
     db_test = aimrocks.DB(db_test_path, opts, read_only=False)
 
     compr_str = get_compr_str(compressor)
     bs_str = get_bs_str(block_size)
-    print(f"{block_size/KiB},{compr_str},", end="")
+    row = ""
+    metrics = {}
+    spans = instrumentation.Spans()
+    write_timer = instrumentation.Timer()
+    sg_timer = instrumentation.Timer(hist=True)
+    mg_timer = instrumentation.Timer(hist=True)
+    row += f"{block_size/KiB},{compr_str},"
 
     ##################
     # sort if needed #
     ##################
-    sort_start = time.time()
-    sorted_df = sort_df(metadata_list, order)
-    sort_end = time.time()
-    sort_time = round(sort_end - sort_start)
-    print(f"{order},{sort_time},", end="")
+    # the keys are built once and used both to sort and to insert
+    with spans.span("sort"):
+        index_len = len(str(metadata.num_rows))
+        order_keys = keys.build_keys(
+            metadata, order, index_len, max_size, encoding=key_encoding
+        )
+        if order != "parquet":
+            permutation = keys.sort_permutation(
+                order_keys, permutation_path(order, key_encoding)
+            )
+        else:
+            permutation = np.arange(metadata.num_rows)
+    sort_time = round(spans.seconds("sort"))
+    row += f"{order},{insert_mode},{key_encoding},"
+    row += f"{get_cache_str(block_cache_size)},{bloom_bits},{dict_bytes / KiB},"
+    row += f"{get_load_str(load_compressor)},{write_path},{sort_time},"
 
     #####################
     # build the test db #
     #####################
-    tot_insert_time = 0
-    index_len = len(str(len(metadata_list)))
     batch_size = 10000
-    ins_size = 0
-    # for each row in df, get from txt_contents and insert in test_db
-    batch_write = aimrocks.WriteBatch()
-    for i, row in enumerate(sorted_df):
-        sha = str(row["hexsha"])
-        ins_size += int(str(row["size"]))
-        mmap_coords = txt_index[sha]
-        start = mmap_coords[0]
-        length = mmap_coords[1]
-        txt_mmap.seek(start)
-        content = txt_mmap.read(length)
-        key = make_key(order, index_len, max_size, i, row)
-        batch_write.put(str.encode(key), content)
-        if int(i) % batch_size == 0 or (
-            i == len(sorted_df) - 1 and batch_write.count() > 0  # last iteration
-        ):
-            start_write = time.time()
-            db_test.write(batch_write)
-            end_write = time.time()
-            tot_insert_time += end_write - start_write
+    ins_size = pc.sum(metadata["size"]).as_py()
+    # find where the contents are, in insertion order
+    starts, lengths = txt_index.lookup(metadata["hexsha"])
+    starts = starts[permutation]
+    lengths = lengths[permutation]
+    # the kernel readahead only helps if we scan the contents file in order
+    txt_contents.advise(sequential=order == "parquet")
+    if prefetch_contents:
+        txt_contents.prefetch(starts[: 2 * batch_size], lengths[: 2 * batch_size])
+    with spans.span("insert"):
+        # for each row in sorted order, get from txt_contents and insert in test_db
+        batch_write = aimrocks.WriteBatch()
+        for first in range(0, metadata.num_rows, batch_size):
+            last = first + batch_size
+            # ask for the contents two batches ahead while this one is written,
+            # so the next one has a whole batch of time to be read in
+            if prefetch_contents:
+                ahead = slice(last + batch_size, last + 2 * batch_size)
+                txt_contents.prefetch(starts[ahead], lengths[ahead])
+            batch_keys = order_keys.take(permutation[first:last])
+            batch_keys = pc.cast(batch_keys, pa.large_binary()).to_pylist()
+            batch_coords = zip(
+                starts[first:last].tolist(), lengths[first:last].tolist()
+            )
+            for key, (start, length) in zip(batch_keys, batch_coords):
+                batch_write.put(key, txt_contents.get(start, length))
+            with write_timer:
+                db_test.write(
+                    batch_write, **db_options.write_options(insert_mode, write_profile)
+                )
             batch_write.clear()
+    with spans.span("flush/compaction"), write_timer:
+        db_options.finish_insert(db_test, insert_mode, write_profile)
+    # wait for the background work (and compact all the db) before measuring
+    # it. This is timed too: every insert mode and write path is timed until
+    # its data is flushed and no compaction is left
+    with spans.span("settle"), write_timer:
+        db_options.settle(db_test, config.full_compaction)
+    settle_time = round(spans.seconds("settle"), 2)
     # compute throughput
-    ins_thr = round(ins_size / MiB / tot_insert_time, 2)
-    results["ins_thr"][bs_str][compr_str] = ins_thr
-    print(f"{ins_thr},", end="")
+    ins_thr = round(ins_size / MiB / write_timer.seconds, 2)
+    metrics["ins_thr"] = ins_thr
+    row += f"{ins_thr},"
+
+    # bytes written by the flushes and compactions for every byte of the
+    # settled SST files (1 when every byte is written once)
+    write_stats = db_options.compaction_stats(db_test)
+    written = write_stats["flush_bytes"] + write_stats["compaction_write_bytes"]
+    stored = sum(size for _, size in db_options.level_stats(db_test))
+    write_amp = round(written / stored, 2) if stored else 0
+    metrics["write_amp"] = write_amp
+    metrics["settle_time"] = settle_time
+    row += (
+        f"{settle_time},{round(write_stats['flush_bytes'] / MiB, 2)},"
+        f"{round(write_stats['compaction_read_bytes'] / MiB, 2)},"
+        f"{round(write_stats['compaction_write_bytes'] / MiB, 2)},{write_amp},"
+    )
+
+    # rewrite the files loaded with the load compressor with the final one
+    recompress_time = 0
+    if load_compressor is not None:
+        with spans.span("recompress"):
+            opts = db_options.make_options(
+                compressor,
+                block_size,
+                create=False,
+                insert_mode=insert_mode,
+                target_file_size=config.target_file_size,
+                table=table,
+                dict_bytes=dict_bytes,
+                write_path=write_profile,
+            )
+            del db_test
+            db_test = db_options.recompress(db_test_path, opts)
+        recompress_time = round(spans.seconds("recompress"), 2)
+    metrics["recompress_time"] = recompress_time
+    row += f"{recompress_time},"
 
     #########################################
     # measure db size and compression ratio #
@@ -271,39 +245,47 @@ def test_rocksdb(
     tot_db_size = 0
     tot_sst_size = 0
     tot_sst_files = 0
-    for dirpath, _, filenames in os.walk(db_test_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            try:
-                if not os.path.islink(fp):
-                    fsize = os.path.getsize(fp)
-                    tot_db_size += fsize
-                    if f.endswith(".sst"):
-                        tot_sst_size += fsize
-                        tot_sst_files += 1
-            except Exception as e:
-                print(e)
+    with spans.span("size measure"):
+        for dirpath, _, filenames in os.walk(db_test_path):
+            for f in filenames:
+                fp = os.path.join(dirpath, f)
+                try:
+                    if not os.path.islink(fp):
+                        fsize = os.path.getsize(fp)
+                        tot_db_size += fsize
+                        if f.endswith(".sst"):
+                            tot_sst_size += fsize
+                            tot_sst_files += 1
+                except Exception as e:
+                    print(e)
     compr_ratio = round((tot_db_size * 100) / parq_size_b, 2)
     compr_ratio_ssts = round((tot_sst_size * 100) / parq_size_b, 2)
     avg_sst_size_mb = (
         round((tot_sst_size / MiB) / tot_sst_files, 2) if tot_sst_files != 0 else 0
     )
-    results["compr_ratio"][bs_str][compr_str] = compr_ratio
-    print(f"{compr_ratio} ({compr_ratio_ssts} no logs),{avg_sst_size_mb},", end="")
+    metrics["compr_ratio"] = compr_ratio
+    row += f"{compr_ratio} ({compr_ratio_ssts} no logs),{avg_sst_size_mb},"
+    # size of the index and filter blocks and of the keys, summed over the SST files
+    table_props = db_options.table_properties(db_test)
+    index_size_mb = round(db_options.index_block_size(table_props) / MiB, 3)
+    filter_size_mb = round(table_props.get("filter block size", 0) / MiB, 3)
+    avg_key_size = round(table_props.get("raw average key size", 0), 2)
+    metrics["index_size"] = index_size_mb
+    row += f"{index_size_mb},{filter_size_mb},{avg_key_size},"
+    # shape of the LSM tree and RocksDB estimates of the live data and keys
+    levels = db_options.level_stats(db_test)
+    live_data = int(db_test.get_property(b"rocksdb.estimate-live-data-size") or 0)
+    num_keys = int(db_test.get_property(b"rocksdb.estimate-num-keys") or 0)
+    row += f"{round(live_data / MiB, 2)},{num_keys},{db_options.levels_str(levels)},"
 
     ### Close the DB and reopen it
     if readonly:
-        db_test.close()
-        opts = aimrocks.Options()
-        opts.create_if_missing = False
-        opts.error_if_exists = False
-        opts.allow_mmap_reads = True
-        opts.paranoid_checks = False
-        opts.use_adaptive_mutex = True
-        opts.compression = compr
-        if level != 0:
-            opts.compression_opts = {"level": level}
-        opts.table_factory = aimrocks.BlockBasedTableFactory(block_size=block_size)
+        # drop the handle rather than close() it: an aimrocks DB closed by
+        # hand crashes when it is garbage collected
+        del db_test
+        opts = db_options.make_options(
+            compressor, block_size, create=False, table=table
+        )
         db_test_read = aimrocks.DB(db_test_path, opts, read_only=True)
     else:
         db_test_read = db_test
@@ -315,57 +297,116 @@ def test_rocksdb(
     found_sg = 0
     found_mg = 0
     got_size = 0
-    ind_query = 1
     keys_mget = []
-    tot_sg_time = 0
-    tot_mg_time = 0
-    index_len = len(str(len(metadata_list)))
-    for i, row in enumerate(metadata_list):
-        if int(i) in queries:
-            key = make_key(order, index_len, max_size, i, row)
-            query_log.append(str(key))
-            keys_mget.append(str.encode(key))
+    # queries are made in the order of the parquet file
+    with spans.span("query"):
+        query_keys = order_keys.take(np.sort(queries))
+        query_keys = pc.cast(query_keys, pa.large_binary()).to_pylist()
+        for i, key in enumerate(query_keys):
+            # binary keys are logged in hexadecimal
+            query_log.append(key.decode() if key_encoding == "text" else key.hex())
+            keys_mget.append(key)
             # test single get
-            start_sg_time = time.time()
-            got = db_test_read.get(str.encode(key))
-            end_sg_time = time.time()
-            tot_sg_time += end_sg_time - start_sg_time
+            start_sg_time = time.perf_counter_ns()
+            got = db_test_read.get(key)
+            sg_timer.add(time.perf_counter_ns() - start_sg_time)
             got_size += len(got)
             found_sg += sum(x is not None for x in [got])
-            ind_query += 1
-        # test multi get
-        if ind_query % 100 == 0 or (i == len(metadata_list) - 1 and len(keys_mget) > 0):
-            start_mg_time = time.time()
-            gotlist = db_test_read.multi_get(keys_mget)
-            end_mg_time = time.time()
-            keys_mget.clear()
-            ind_query = 1
-            tot_mg_time += end_mg_time - start_mg_time
-            found_mg += sum(x is not None for x in gotlist)
+            # test multi get
+            if len(keys_mget) == 100 or i == len(query_keys) - 1:
+                start_mg_time = time.perf_counter_ns()
+                gotlist = db_test_read.multi_get(keys_mget)
+                mg_timer.add(time.perf_counter_ns() - start_mg_time)
+                keys_mget.clear()
+                found_mg += sum(x is not None for x in gotlist.values())
     if found_sg != len(queries):
-        print(f"\nERROR: found {found_sg} out of {len(queries)} queries")
+        print(f"ERROR: found {found_sg} out of {len(queries)} queries")
     if not (found_sg == found_mg):
-        print(f"\nERROR: found numbers differ: {found_sg}, {found_mg}")
+        print(f"ERROR: found numbers differ: {found_sg}, {found_mg}")
     # compute times
-    sg_thr = (got_size / MiB) / tot_sg_time
-    mg_thr = (got_size / MiB) / tot_mg_time
-    results["sg_thr"][bs_str][compr_str] = round(sg_thr, 2)
-    results["mg_thr"][bs_str][compr_str] = round(mg_thr, 2)
-    print(f"{round(sg_thr, 2)},{round(mg_thr, 2)}")
+    sg_thr = (got_size / MiB) / sg_timer.seconds
+    mg_thr = (got_size / MiB) / mg_timer.seconds
+    metrics["sg_thr"] = round(sg_thr, 2)
+    metrics["mg_thr"] = round(mg_thr, 2)
+    metrics["sg_p50"] = round(sg_timer.hist.percentile(50) / 1000, 2)
+    row += f"{round(sg_thr, 2)},{round(mg_thr, 2)},"
+    # what the queries left in the block cache
+    cache_usage, cache_pinned = db_options.block_cache_usage(db_test_read)
+    row += f"{round(cache_usage / MiB, 2)},{round(cache_pinned / MiB, 2)},"
+
+    ######################
+    # concurrent readers #
+    ######################
+    read_result = None
+    if config.read_threads > 0:
+        with spans.span("read load"):
+            # the keys in the db, in insertion order
+            workload = read_load.make_workload(
+                order_keys.take(permutation),
+                config.read_distribution,
+                config.read_ops,
+                config.read_zipf_s,
+                config.read_replay_path,
+                hex_keys=key_encoding == "binary",
+            )
+            open_db = functools.partial(
+                aimrocks.DB,
+                db_test_path,
+                db_options.make_options(
+                    compressor, block_size, create=False, table=table
+                ),
+                read_only=True,
+            )
+            read_result = read_load.run(
+                db_test_read,
+                workload,
+                config.read_threads,
+                config.read_processes,
+                open_db,
+            )
+            if config.read_distribution != "replay" and read_result["found"] != len(
+                workload
+            ):
+                print(
+                    f"ERROR: read load found {read_result['found']} of {len(workload)}"
+                )
+    row += read_load.csv_fields(
+        config.read_distribution,
+        config.read_threads,
+        config.read_processes,
+        read_result,
+    )
+    metrics["instrumentation"] = instrumentation.to_json(
+        {
+            "phases": spans,
+            "timers": {
+                "write": write_timer,
+                "single_get": sg_timer,
+                "multi_get": mg_timer,
+            },
+            "read_load": read_result,
+            "compaction": write_stats,
+            "levels": levels,
+        }
+    )
     # print the query log to file
     if querylog:
-        with open(f"query_log-{PID}/{compr_str}_{bs_str}_{order}.json", "w") as f:
+        with open(
+            f"query_log-{PID}/{compr_str}_{bs_str}_{order}_{key_encoding}.json", "w"
+        ) as f:
             f.write(json.dumps(query_log, indent=4))
 
     #################
     # delete the db #
     #################
     del db_test_read
-    del sorted_df
+    del order_keys
     if not keep_db:
         if os.path.exists(db_test_path):
             shutil.rmtree(db_test_path)
 
+    return row, metrics
+
 
 if __name__ == "__main__":
     print(f"Start computation at {time.asctime()}")
@@ -377,28 +418,50 @@ if __name__ == "__main__":
     print(f"Dataset {config.parquet_path}, size {round(parq_size_b / MiB, 3)} MiB")
     print(f"Number of queries: {n_queries}")
     print(f"Read only: {readonly}")
+    print(f"Fingerprint workers: {config.fingerprint_workers}")
     print()
 
     print(f"Orderings: {config.orders}")
     print(f"Compressors: {[get_compr_str(c) for c in config.compressors]}")
     print(f"Block sizes: {[get_bs_str(b) for b in config.block_sizes]}")
+    print(f"Insert modes: {config.insert_modes}")
+    print(f"Full compaction before measuring: {config.full_compaction}")
+    print(f"Key encodings: {config.key_encodings}")
+    print(f"Block caches (MiB): {[get_cache_str(c) for c in config.block_cache_sizes]}")
+    print(f"Bloom filter bits per key: {config.bloom_bits}")
+    print(f"Dictionary sizes (KiB): {[d / KiB for d in config.dict_bytes]}")
+    print(f"Load compressors: {[get_load_str(c) for c in config.load_compressors]}")
+    print(f"Write paths: {list(config.write_paths)}")
+    n_workers = sweep.max_workers(
+        config.sweep_workers,
+        config.rocksdb_output_path,
+        config.sweep_disk_per_test,
+        config.sweep_mem_per_test,
+    )
+    print(f"Parallel tests: {n_workers}")
+    print(
+        f"Read load: {config.read_ops} {config.read_distribution} reads, "
+        f"{config.read_processes} processes x {config.read_threads} threads"
+    )
+    print(f"Results ledger: {config.results_ledger_dir}")
     print()
 
+    run_spans = instrumentation.Spans()
     # open the contents txt with mmap and the index file
-    txt_start = time.time()
-    txt_contents_file = open(config.contents_path, "r")
-    txt_mmap = mmap.mmap(txt_contents_file.fileno(), length=0, access=mmap.PROT_READ)
-    with open(config.contents_index_path, "r") as f:
-        txt_index = json.load(f)
-    txt_end = time.time()
-    print(f"Opened contents txt and read txt index: {round(txt_end - txt_start)} s")
+    txt_start = time.perf_counter_ns()
+    txt_contents = contents_store.ContentsFile(config.contents_path)
+    txt_index = contents_store.ContentsIndex(config.contents_index_path)
+    txt_end = time.perf_counter_ns()
+    run_spans.add("open contents", txt_start, txt_end)
+    print(
+        f"Opened contents txt and read txt index: {round(run_spans.seconds('open contents'))} s"
+    )
 
     # read parquet to create metadata dataframe
-    start_reading = time.time()
-    metadata_list = []
-    max_size = 0
+    start_reading = time.perf_counter_ns()
+    metadata_batches = []
     parquet_file = pq.ParquetFile(config.parquet_path)
-    for batch in parquet_file.iter_batches(
+    batches = parquet_file.iter_batches(
         columns=[
             "hexsha",
             "max_stars_repo_path",
@@ -407,6 +470,16 @@ if __name__ == "__main__":
             "size",
             "lang",
         ]
+    )
+    worker_stats = {}
+    fp_cache = None
+    if config.fingerprint_cache_path is not None:
+        fp_cache = fingerprints.FingerprintCache(config.fingerprint_cache_path)
+        print(
+            f"Fingerprint cache {config.fingerprint_cache_path}: {len(fp_cache)} entries"
+        )
+    for batch, batch_tlsh in fingerprints.iter_fingerprints(
+        batches, "content", config.fingerprint_workers, worker_stats, fp_cache
     ):
         try:
             batch = batch.rename_columns(
@@ -419,21 +492,42 @@ if __name__ == "__main__":
                     "lang": "lang",
                 }
             )
-            batch_list = batch.to_pylist()
-            # replace content with its fingerprint
-            for row in batch_list:
-                content = row["tlsh"]
-                size = row["size"]
-                max_size = max(max_size, size)
-                row["tlsh"] = create_tlsh(content)
-            metadata_list += batch_list
+            # keep the metadata compact: shas as raw digests, sizes as
+            # uint32, languages dictionary encoded and the content replaced
+            # with its fingerprint
+            batch = pa.record_batch(
+                {
+                    "hexsha": contents_store.bin_to_arrow(
+                        contents_store.hexsha_to_bin(batch["hexsha"])
+                    ),
+                    "filename": batch["filename"],
+                    "tlsh": pa.array(batch_tlsh, type=pa.string()),
+                    "size": pc.cast(batch["size"], pa.uint32()),
+                    "lang": pc.dictionary_encode(batch["lang"]),
+                }
+            )
+            metadata_batches.append(batch)
         except Exception as e:
             print(e)
-    # concatenate the results
-    end_reading = time.time()
+    # concatenate the results, unifying the language dictionaries
+    metadata = pa.Table.from_batches(metadata_batches).unify_dictionaries()
+    del metadata_batches
+    max_size = pc.max(metadata["size"]).as_py()
+    end_reading = time.perf_counter_ns()
+    run_spans.add(
+        "read parquet",
+        start_reading,
+        end_reading,
+        fingerprint_workers=worker_stats,
+    )
     print(
-        f"Reading parquet and computing fingerprints: {round(end_reading - start_reading)} s\n"
+        f"Reading parquet and computing fingerprints: {round(run_spans.seconds('read parquet'))} s "
+        f"({fingerprints.worker_throughput(worker_stats)})"
     )
+    if fp_cache is not None:
+        print(f"Fingerprint cache: {fp_cache.hit_rate()}")
+    print(f"Metadata in memory: {round(metadata.nbytes / MiB, 3)} MiB")
+    print()
 
     # setup histogram results dictionary
     for m in metrics:
@@ -453,30 +547,134 @@ if __name__ == "__main__":
         os.makedirs(f"query_log-{PID}")
 
     # create queries list
-    if n_queries == 0 or n_queries > len(metadata_list):
-        n_queries = len(metadata_list)
-    queries = list(np.random.permutation(len(metadata_list))[:n_queries])
-
-    print(
-        "BLOCK_SIZE(KiB),COMPRESSION,ORDER,SORTING_TIME(s),INSERT_THROUGHPUT(MiB/s),COMPRESSION_RATIO(%),AVG_SST_FILE_SIZE(MiB),SINGLE_GET_THROUGHPUT(MiB/s),MULTI_GET_THROUGHPUT(MiB/S)"
+    if n_queries == 0 or n_queries > metadata.num_rows:
+        n_queries = metadata.num_rows
+    queries = list(np.random.permutation(metadata.num_rows)[:n_queries])
+
+    header = "BLOCK_SIZE(KiB),COMPRESSION,ORDER,INSERT_MODE,KEY_ENCODING,BLOCK_CACHE(MiB),BLOOM_BITS,DICT_SIZE(KiB),LOAD_COMPRESSION,WRITE_PATH,SORTING_TIME(s),INSERT_THROUGHPUT(MiB/s),SETTLE_TIME(s),FLUSH_WRITE(MiB),COMPACTION_READ(MiB),COMPACTION_WRITE(MiB),WRITE_AMP,RECOMPRESS_TIME(s),COMPRESSION_RATIO(%),AVG_SST_FILE_SIZE(MiB),INDEX_SIZE(MiB),FILTER_SIZE(MiB),AVG_KEY_SIZE(B),LIVE_DATA(MiB),NUM_KEYS,LEVELS,SINGLE_GET_THROUGHPUT(MiB/s),MULTI_GET_THROUGHPUT(MiB/S),BLOCK_CACHE_USAGE(MiB),BLOCK_CACHE_PINNED(MiB),"
+    header += read_load.CSV_HEADER
+    print(header)
+    # run tests, every configuration of the grid is independent
+    cells = [
+        {
+            "compressor": compr,
+            "order": order,
+            "block_size": block_size,
+            "insert_mode": insert_mode,
+            "key_encoding": key_encoding,
+            "block_cache_size": block_cache_size,
+            "bloom_bits": bits,
+            "dict_bytes": dict_bytes,
+            "load_compressor": load_compr,
+            "write_path": write_path,
+        }
+        for block_size in config.block_sizes
+        for compr in config.compressors
+        for order in config.orders
+        for insert_mode in config.insert_modes
+        for key_encoding in config.key_encodings
+        for block_cache_size in config.block_cache_sizes
+        for bits in config.bloom_bits
+        for dict_bytes in config.dict_bytes
+        for load_compr in config.load_compressors
+        for write_path in config.write_paths
+    ]
+    test = functools.partial(
+        test_rocksdb,
+        txt_contents=txt_contents,
+        txt_index=txt_index,
+        metadata=metadata,
+        max_size=max_size,
+        queries=queries,
     )
-    # run tests
-    for block_size in config.block_sizes:
-        for compr in config.compressors:
-            test_orders = config.orders
-            for order in test_orders:
-                test_rocksdb(
-                    txt_mmap=txt_mmap,
-                    txt_index=txt_index,
-                    metadata_list=metadata_list,
-                    compressor=compr,
-                    order=order,
-                    block_size=block_size,
-                    max_size=max_size,
-                    queries=queries,
-                )
+    # tests already in the ledger of a previous run are not repeated
+    ledger = None
+    if config.results_ledger_dir is not None:
+        dataset = os.path.splitext(os.path.basename(config.parquet_path))[0]
+        ledger = sweep.Ledger(
+            f"{config.results_ledger_dir}ledger-pre_sorted-{dataset}.csv", header
+        )
+
+    test_results = sweep.run_ledger(test, cells, n_workers, ledger, get_ledger_id)
+    tests_instrumentation = []
+    tests_metrics = []
+    for cell, (row, test_metrics) in zip(cells, test_results):
+        print(row)
+        tests_metrics.append(test_metrics)
+        tests_instrumentation.append(
+            {"test": get_test_id(cell), **test_metrics.get("instrumentation", {})}
+        )
+        bs_str = get_bs_str(cell["block_size"])
+        compr_str = get_compr_str(cell["compressor"])
+        for m in metrics:
+            results[m][bs_str][compr_str] = test_metrics[m]
     print()
 
+    # change given by the compression dictionaries, against no dictionary
+    dict_deltas = sweep.baseline_deltas(
+        cells, tests_metrics, "dict_bytes", 0, ["compr_ratio", "sg_p50", "sg_thr"]
+    )
+    if dict_deltas:
+        print(
+            "TEST,DICT_SIZE(KiB),COMPRESSION_RATIO_CHANGE(%),SINGLE_GET_P50_CHANGE(%),SINGLE_GET_THROUGHPUT_CHANGE(%)"
+        )
+        for cell, delta in dict_deltas:
+            print(
+                f"{get_test_id(cell)},{cell['dict_bytes'] / KiB},{delta['compr_ratio']},"
+                f"{delta['sg_p50']},{delta['sg_thr']}"
+            )
+        print()
+
+    # insert throughput of every write path, against the first one
+    path_deltas = sweep.baseline_deltas(
+        cells,
+        tests_metrics,
+        "write_path",
+        next(iter(config.write_paths)),
+        ["ins_thr", "write_amp"],
+    )
+    if path_deltas:
+        print("TEST,WRITE_PATH,INSERT_THROUGHPUT_CHANGE(%),WRITE_AMP_CHANGE(%)")
+        for cell, delta in path_deltas:
+            print(
+                f"{get_test_id(cell)},{cell['write_path']},{delta['ins_thr']},"
+                f"{delta['write_amp']}"
+            )
+        print()
+        # fastest write path of every order, with the time it waited for
+        # the compactions it left behind (part of its insert throughput)
+        print("ORDER,WRITE_PATH,INSERT_THROUGHPUT(MiB/s),SETTLE_TIME(s),WRITE_AMP")
+        for order in config.orders:
+            cell, m = max(
+                (
+                    (cell, m)
+                    for cell, m in zip(cells, tests_metrics)
+                    if cell["order"] == order
+                ),
+                key=lambda cell_m: cell_m[1]["ins_thr"],
+            )
+            print(
+                f"{order},{cell['write_path']},{m['ins_thr']},"
+                f"{m['settle_time']},{m['write_amp']}"
+            )
+        print()
+
+    # export the timings of the run and of every test next to the results
+    if config.instrumentation_dir is not None:
+        dataset = os.path.splitext(os.path.basename(config.parquet_path))[0]
+        instr_path = f"{config.instrumentation_dir}instrumentation-pre_sorted-{dataset}-{PID}.json"
+        instrumentation.export_json(
+            instr_path,
+            {
+                "benchmark": "pre_sorted",
+                "dataset": config.parquet_path,
+                "phases": run_spans,
+                "tests": tests_instrumentation,
+            },
+        )
+        print(f"Timings exported to {instr_path}")
+        print()
+
     # create histograms for the results
     if make_charts:
         charts_dir = f"charts_benchmark-{PID}"
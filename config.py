@@ -1,3 +1,5 @@
+import os
+
 import aimrocks
 
 KiB = 1024
@@ -6,9 +8,127 @@ GiB = 1024 * 1024 * 1024
 
 parquet_path = "data/the-stack-64M.parquet"
 contents_path = "data/the-stack-64M-contents.txt"
-contents_index_path = "data/the-stack-64M-contents-index.json"
+contents_index_path = "data/the-stack-64M-contents-index.bin"
 rocksdb_output_path = "data/"
 
+# number of processes computing the TLSH fingerprints (1 to compute them inline)
+fingerprint_workers = os.cpu_count() or 1
+# sidecar caching the fingerprints by hexsha across runs (None to disable it)
+fingerprint_cache_path = "data/the-stack-64M-tlsh.parquet"
+
+# how benchmark-not_sorted.py inserts every order (orders not listed use "stream"):
+#   "stream" writes the batches as they are read and lets RocksDB sort the keys
+#   "external-sort" spills key-sorted runs to disk and merges them into the db
+ingest_modes = {
+    # "ext-filename-nopath": "external-sort",
+}
+# bytes of keys and contents buffered in memory before spilling a sorted run
+run_size = 256 * MiB
+
+# how the key-value pairs are inserted in the test dbs (see db_options.py):
+# "writebatch" for normal writes, "ingest" to bulk load them
+insert_modes = [
+    "writebatch",
+    # "ingest",
+]
+# size of the SST files written by the "ingest" insert mode
+target_file_size = 64 * MiB
+# after the inserts, every test waits for the background flushes and
+# compactions before measuring the db; with full_compaction it also flushes
+# the memtables and compacts all the db, for sizes and write amplification
+# that don't depend on when RocksDB would have compacted it
+full_compaction = False
+
+# write path of the inserts, every profile is tested. A profile sets some of
+# db_options.WRITE_PATH_OPTIONS on top of the insert mode: memtable size and
+# number, background jobs, L0 triggers, no automatic compactions during the
+# load (then one compaction at the end), sync writes or no WAL. Inserts are
+# timed until the data is flushed and no compaction is left, whatever the
+# profile
+write_paths = {
+    "default": {},
+    # "bulk": {
+    #     "write_buffer_size": 256 * MiB,
+    #     "max_write_buffer_number": 4,
+    #     "max_background_jobs": os.cpu_count() or 1,
+    #     "level0_slowdown_writes_trigger": 64,
+    #     "level0_stop_writes_trigger": 128,
+    #     "disable_auto_compactions": True,
+    #     "disable_wal": True,
+    # },
+}
+
+# block based table of the test dbs, every combination is tested.
+# Bytes of the LRU block cache, shared by all the handles of a test db in the
+# same process (None for the RocksDB default of 8 MiB per handle, 0 for none)
+block_cache_sizes = [
+    None,
+    # 64 * MiB,
+    # 1 * GiB,
+]
+# bits per key of the bloom filter (0 for no filter)
+bloom_bits = [
+    0,
+    # 10,
+]
+
+# size of the compression dictionary of every SST file (0 for none). RocksDB
+# samples it from the file itself, so with the PPC orders every dictionary
+# covers files of the same extension
+dict_bytes = [
+    0,
+    # 16 * KiB,
+    # 64 * KiB,
+]
+
+# compressor used while inserting the data (None for the compressor of the
+# test): the db is then reopened with the compressor of the test and fully
+# compacted, so the final files have the slow compressor and the inserts pay
+# only the fast one. aimrocks has no per-level or bottommost compression
+load_compressors = [
+    None,
+    # (aimrocks.CompressionType.lz4_compression, 0),
+    # (aimrocks.CompressionType.snappy_compression, 0),
+]
+
+# how the keys are encoded (see keys.py): "text" (prefix_size-hexsha) or
+# "binary" (prefix_, big-endian size and raw sha, shorter; the order is the
+# same except between prefixes where one extends the other, see keys.py)
+key_encodings = [
+    "text",
+    # "binary",
+]
+
+# number of configurations of the grid tested at the same time, each one in
+# its own process and with its own db (1 to test them one after the other).
+# It is also capped by the cpus and by how many tests fit in the free disk
+# and memory, given what a single test needs at most
+sweep_workers = 1
+sweep_disk_per_test = 2 * GiB
+sweep_mem_per_test = 4 * GiB
+
+# directory of the ledgers, the durable CSVs of the tests completed by the
+# benchmarks: a benchmark restarted on the same dataset skips the tests already
+# in its ledger (None to disable it)
+results_ledger_dir = "data/"
+# directory caching the sort permutations of benchmark-pre_sorted.py by
+# dataset and order (None to disable it)
+permutation_cache_dir = "data/"
+
+# concurrent read load run on every test db after the single and multi gets
+read_threads = 4  # reader threads per process (0 to skip the read load)
+read_processes = 1  # >1 to fork processes, each one reopening the db read only
+read_ops = 100000  # number of reads
+# key distribution of the reads: "uniform", "zipf", "insert-order" or
+# "replay" (of read_replay_path, a JSON list of keys like the query logs)
+read_distribution = "zipf"
+read_zipf_s = 1.1
+read_replay_path = None
+
+# directory of the JSON files with the timings (phases, latency histograms)
+# of every run of the benchmarks (None to disable them)
+instrumentation_dir = "data/"
+
 # define orders
 orders = [
     # "parquet",  # standard order of the parquet file (by language)
@@ -0,0 +1,229 @@
+import mmap
+import struct
+
+import numpy as np
+import pyarrow as pa
+
+KiB = 1024
+MiB = 1024 * 1024
+GiB = 1024 * 1024 * 1024
+
+# layout of the contents index file:
+#   magic (8 bytes) | number of entries n (uint64)
+#   n sorted sha1 digests of 20 bytes each, padded to a multiple of 8 bytes
+#   n start offsets in the contents file (uint64)
+#   n content sizes in bytes (uint64)
+INDEX_MAGIC = b"PPCIDX01"
+INDEX_HEADER = struct.Struct("<8sQ")
+
+_HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+_HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+_HEX_VALUES[np.frombuffer(b"0123456789", dtype=np.uint8)] = np.arange(10)
+_HEX_VALUES[np.frombuffer(b"abcdef", dtype=np.uint8)] = np.arange(10, 16)
+_HEX_VALUES[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = np.arange(10, 16)
+
+
+def hexsha_array(shas) -> np.ndarray:
+    # view the 40-char hex shas as a fixed-width numpy array, without creating
+    # a Python object per sha when the Arrow buffers allow it
+    if isinstance(shas, pa.ChunkedArray):
+        shas = shas.cast(pa.large_string()).combine_chunks()
+    n = len(shas)
+    if shas.null_count == 0 and shas.type in (pa.string(), pa.large_string()):
+        offset_type = np.int32 if shas.type == pa.string() else np.int64
+        offsets = np.frombuffer(shas.buffers()[1], dtype=offset_type)
+        offsets = offsets[shas.offset : shas.offset + n + 1]
+        if n == 0 or np.all(np.diff(offsets) == 40):
+            return np.frombuffer(
+                shas.buffers()[2], dtype="S40", count=n, offset=int(offsets[0])
+            )
+    return np.array(shas.to_pylist(), dtype="S40")
+
+
+def hexsha_to_arrow(shas: np.ndarray) -> pa.Array:
+    # inverse of hexsha_array, every sha takes exactly 40 bytes
+    offsets = np.arange(0, 40 * (len(shas) + 1), 40, dtype=np.int64)
+    return pa.LargeStringArray.from_buffers(
+        len(shas), pa.py_buffer(offsets), pa.py_buffer(shas.tobytes())
+    )
+
+
+def hexsha_to_bin(shas) -> np.ndarray:
+    # decode hex shas (Arrow strings or a numpy S40 array) into raw 20-byte
+    # digests, vectorized over the whole array
+    if not isinstance(shas, np.ndarray):
+        shas = hexsha_array(shas)
+    digits = _HEX_VALUES[shas.view(np.uint8).reshape(-1, 40)]
+    if np.any(digits == 255):
+        raise ValueError("Invalid hexadecimal sha")
+    digests = (digits[:, 0::2] << 4) | digits[:, 1::2]
+    return np.ascontiguousarray(digests).view("S20").ravel()
+
+
+def bin_to_arrow(shas: np.ndarray) -> pa.Array:
+    # raw 20-byte digests as an Arrow fixed_size_binary(20) array, no copy
+    shas = np.ascontiguousarray(shas, dtype="S20")
+    return pa.FixedSizeBinaryArray.from_buffers(
+        pa.binary(20), len(shas), [None, pa.py_buffer(shas)]
+    )
+
+
+def sha_digests(shas) -> np.ndarray:
+    # view an Arrow fixed_size_binary(20) array of digests as numpy S20
+    if isinstance(shas, pa.ChunkedArray):
+        shas = shas.combine_chunks()
+    return np.frombuffer(
+        shas.buffers()[1], dtype="S20", count=len(shas), offset=20 * shas.offset
+    )
+
+
+def bin_to_hexsha(shas) -> pa.Array:
+    # encode raw digests (numpy S20 or Arrow fixed_size_binary(20)) as an
+    # Arrow array of 40-char hex strings, vectorized over the whole array
+    if not isinstance(shas, np.ndarray):
+        shas = sha_digests(shas)
+    digests = shas.view(np.uint8).reshape(-1, 20)
+    digits = np.empty((len(shas), 40), dtype=np.uint8)
+    digits[:, 0::2] = _HEX_DIGITS[digests >> 4]
+    digits[:, 1::2] = _HEX_DIGITS[digests & 15]
+    return hexsha_to_arrow(digits.view("S40").ravel())
+
+
+def contents_buffer(contents: pa.Array) -> tuple[memoryview, np.ndarray]:
+    """
+    Return the raw bytes of a string/binary Arrow array as a single buffer,
+    with no copy: the values of such arrays are stored back to back, so the
+    bytes of all the contents are a slice of the data buffer. Also returns
+    the size in bytes of every value (0 for nulls).
+    """
+    if pa.types.is_large_string(contents.type) or pa.types.is_large_binary(
+        contents.type
+    ):
+        offset_type = np.int64
+    elif pa.types.is_string(contents.type) or pa.types.is_binary(contents.type):
+        offset_type = np.int32
+    else:
+        raise ValueError(f"Unsupported contents type {contents.type}")
+    n = len(contents)
+    _, offsets, data = contents.buffers()
+    if offsets is None:
+        return memoryview(b""), np.zeros(n, dtype=np.int64)
+    offsets = np.frombuffer(offsets, dtype=offset_type)
+    offsets = offsets[contents.offset : contents.offset + n + 1].astype(np.int64)
+    first, last = int(offsets[0]), int(offsets[-1])
+    view = memoryview(data)[first:last] if data is not None else memoryview(b"")
+    return view, np.diff(offsets)
+
+
+def write_index(path: str, shas: np.ndarray, starts, sizes):
+    """
+    Write the binary contents index, given the raw 20-byte shas and the start
+    offset and size of every content. Entries are sorted by sha here.
+    """
+    order = np.argsort(shas, kind="stable")
+    n = len(order)
+    with open(path, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, n))
+        f.write(shas[order].tobytes())
+        f.write(b"\0" * (-(20 * n) % 8))
+        f.write(np.asarray(starts, dtype="<u8")[order].tobytes())
+        f.write(np.asarray(sizes, dtype="<u8")[order].tobytes())
+
+
+class ContentsIndex:
+    """
+    Read-only view of the binary contents index. The file is mmapped and the
+    arrays point straight into it, so opening it costs no time and no memory
+    besides the pages touched by the lookups.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ)
+        magic, n = INDEX_HEADER.unpack_from(self.mmap, 0)
+        if magic != INDEX_MAGIC:
+            raise Exception(f"{path} is not a contents index")
+        offset = INDEX_HEADER.size
+        self.shas = np.frombuffer(self.mmap, dtype="S20", count=n, offset=offset)
+        offset += 20 * n + (-(20 * n) % 8)
+        self.starts = np.frombuffer(self.mmap, dtype="<u8", count=n, offset=offset)
+        offset += 8 * n
+        self.sizes = np.frombuffer(self.mmap, dtype="<u8", count=n, offset=offset)
+
+    def __len__(self):
+        return len(self.shas)
+
+    def __getitem__(self, hexsha: str) -> tuple[int, int]:
+        sha = np.frombuffer(bytes.fromhex(hexsha), dtype="S20")[0]
+        pos = np.searchsorted(self.shas, sha)
+        if pos == len(self.shas) or self.shas[pos] != sha:
+            raise KeyError(hexsha)
+        return int(self.starts[pos]), int(self.sizes[pos])
+
+    def lookup(self, shas) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized lookup of many shas, given as raw 20-byte digests (numpy
+        S20 or Arrow fixed_size_binary) or as hex strings. Returns the arrays
+        of starts and sizes.
+        """
+        if isinstance(shas, np.ndarray) and shas.dtype == np.dtype("S20"):
+            pass
+        elif shas.type == pa.binary(20):
+            shas = sha_digests(shas)
+        else:
+            shas = hexsha_to_bin(shas)
+        pos = np.searchsorted(self.shas, shas)
+        pos[pos == len(self.shas)] = 0
+        missing = np.flatnonzero(self.shas[pos] != shas)
+        if len(missing) > 0:
+            raise KeyError(shas[missing[0]].ljust(20, b"\0").hex())
+        return self.starts[pos], self.sizes[pos]
+
+
+class ContentsFile:
+    """
+    The contents store mmapped read-only, with helpers to tell the kernel how
+    it is going to be accessed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.mmap)
+
+    def get(self, start: int, size: int) -> bytes:
+        # slicing the mmap builds the bytes object straight from the mapped
+        # pages: this is the only copy made of a content
+        return self.mmap[start : start + size]
+
+    def advise(self, sequential: bool):
+        # sequential scans want aggressive readahead, random orders want none
+        if len(self.mmap) == 0:
+            return
+        self.mmap.madvise(mmap.MADV_SEQUENTIAL if sequential else mmap.MADV_RANDOM)
+
+    def prefetch(self, starts: np.ndarray, sizes: np.ndarray, max_gap: int = 0):
+        """
+        Ask the kernel to start reading the pages of the given contents in
+        background (MADV_WILLNEED). Ranges are page aligned and merged when
+        they overlap or are less than `max_gap` bytes apart, so that the
+        number of syscalls stays small.
+        """
+        if len(starts) == 0:
+            return
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = starts + np.asarray(sizes, dtype=np.int64)
+        order = np.argsort(starts, kind="stable")
+        begins = starts[order] // mmap.PAGESIZE * mmap.PAGESIZE
+        ends = np.maximum.accumulate(ends[order])
+        new_range = np.ones(len(begins), dtype=bool)
+        new_range[1:] = begins[1:] > ends[:-1] + max_gap
+        first = np.flatnonzero(new_range)
+        last = np.append(first[1:], len(begins)) - 1
+        for begin, end in zip(begins[first].tolist(), ends[last].tolist()):
+            if end > begin:
+                self.mmap.madvise(mmap.MADV_WILLNEED, begin, end - begin)
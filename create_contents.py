@@ -1,18 +1,36 @@
-import json
 import os
 import time
 
+import numpy as np
 from pyarrow.parquet import ParquetFile
 
+import contents_store
+
 KiB = 1024
 MiB = 1024 * 1024
 GiB = 1024 * 1024 * 1024
 
-txt_size = float("inf")
+use_writev = False  # True to write with os.writev, False to use a buffered file
+write_buffer_size = 64 * MiB  # bytes accumulated before hitting the disk
 
 parquet_path = "/path/to/repo/data/the-stack-64M.parquet"
 contents_path = f"/path/to/repo/data/the-stack-64M-contents.txt"
-contents_index_path = f"/path/to/repo/data/the-stack-64M-contents-index.json"
+contents_index_path = f"/path/to/repo/data/the-stack-64M-contents-index.bin"
+
+
+def writev_all(fd: int, views: list[memoryview]):
+    # os.writev can write less than requested and takes at most IOV_MAX buffers
+    iov_max = os.sysconf("SC_IOV_MAX")
+    while views:
+        written = os.writev(fd, views[:iov_max])
+        done = 0
+        while done < len(views) and written >= len(views[done]):
+            written -= len(views[done])
+            done += 1
+        views = views[done:]
+        if views and written > 0:
+            views[0] = views[0][written:]
+
 
 if __name__ == "__main__":
     print(f"Starting at {time.asctime()}")
@@ -26,27 +44,57 @@ if __name__ == "__main__":
         exit()
 
     print(f"Building the file {contents_path}")
-    sha_sizes = {}  # made of { sha: (start_index, size) }
+    shas = []
+    starts = []
+    sizes = []
     tot_put_time = 0
+    tot_size = 0
+    wrong_sizes = 0
 
-    with open(contents_path, "a+") as f:
-        tot_size = 0
+    # contents are written as raw bytes straight from the Arrow buffers, and
+    # offsets come from the bytes actually written, not from the size column
+    with open(contents_path, "wb", buffering=write_buffer_size) as f:
+        pending = []
+        pending_size = 0
         pf = ParquetFile(parquet_path)
         for batch in pf.iter_batches(columns=["hexsha", "size", "content"]):
-            for i in range(len(batch["hexsha"])):
-                sha = str(batch["hexsha"][i])
-                content = str(batch["content"][i])
-                size = int(str(batch["size"][i]))
-                sha_sizes[sha] = (tot_size, size)
-                tot_size += size
-                start_put = time.time()
-                f.write(content)
-                end_put = time.time()
-                tot_put_time += end_put - start_put
+            data, batch_sizes = contents_store.contents_buffer(batch["content"])
+            shas.append(contents_store.hexsha_to_bin(batch["hexsha"]))
+            starts.append(tot_size + np.cumsum(batch_sizes) - batch_sizes)
+            sizes.append(batch_sizes)
+            wrong_sizes += np.count_nonzero(
+                batch_sizes != batch["size"].to_numpy(zero_copy_only=False)
+            )
+            tot_size += len(data)
+            start_put = time.time()
+            if use_writev:
+                pending.append(data)
+                pending_size += len(data)
+                if pending_size >= write_buffer_size:
+                    writev_all(f.fileno(), pending)
+                    pending = []
+                    pending_size = 0
+            else:
+                f.write(data)
+            end_put = time.time()
+            tot_put_time += end_put - start_put
+        start_put = time.time()
+        if pending:
+            writev_all(f.fileno(), pending)
+        f.flush()
+        end_put = time.time()
+        tot_put_time += end_put - start_put
+
+    if wrong_sizes != 0:
+        print(f"{wrong_sizes} contents differ in size from the parquet size column")
 
     print(f"Building the file {contents_index_path}")
-    with open(contents_index_path, "w") as f:
-        f.write(json.dumps(sha_sizes, indent=4))
+    contents_store.write_index(
+        contents_index_path,
+        np.concatenate(shas),
+        np.concatenate(starts),
+        np.concatenate(sizes),
+    )
 
     print(
         f"Total time to write {round(tot_put_time, 3)} s, {round((tot_size / MiB) / tot_put_time, 3)} MiB/s"
@@ -0,0 +1,276 @@
+import re
+import time
+
+import aimrocks
+
+KiB = 1024
+MiB = 1024 * 1024
+GiB = 1024 * 1024 * 1024
+
+# ways of inserting the key-value pairs in the test dbs:
+#   "writebatch" goes through the WAL and the memtables and lets RocksDB
+#       compact the flushed files as it wants
+#   "ingest" bulk loads the data: no WAL and no automatic compactions, every
+#       memtable is flushed as an SST file of about the target size and a
+#       single manual compaction settles the files at the end (see
+#       finish_insert). Sorted input makes that compaction a trivial move.
+# Both are timed until the memtables are flushed and RocksDB has no
+# compactions left (see finish_insert and settle).
+INSERT_MODES = ["writebatch", "ingest"]
+
+# options of the write path that a profile of config.write_paths can set, on
+# top of the insert mode. The first ones are RocksDB options; "sync" and
+# "disable_wal" go to every write, and with "disable_auto_compactions" the
+# db is compacted once at the end of the inserts (see finish_insert). Every
+# profile is timed until its memtables are flushed and no compaction is
+# left, so the compactions a profile defers are charged to it too.
+# max_background_jobs is split in flushes and compactions as RocksDB does,
+# since aimrocks only has max_background_flushes/compactions. aimrocks
+# doesn't expose unordered_write nor enable_pipelined_write
+WRITE_PATH_OPTIONS = [
+    "write_buffer_size",
+    "max_write_buffer_number",
+    "min_write_buffer_number_to_merge",
+    "max_background_jobs",
+    "level0_file_num_compaction_trigger",
+    "level0_slowdown_writes_trigger",
+    "level0_stop_writes_trigger",
+    "disable_auto_compactions",
+    "sync",
+    "disable_wal",
+]
+
+
+def table_options(block_cache_size: int = None, bloom_bits: int = 0) -> dict:
+    """
+    Keyword arguments of BlockBasedTableFactory for a test db: an LRU block
+    cache of `block_cache_size` bytes (None for the RocksDB default of 8 MiB,
+    0 for no block cache) and a bloom filter of `bloom_bits` bits per key (0
+    for no filter).
+
+    The same dict can be given to make_options() more times, so that all the
+    handles of a test db opened by a process share the same block cache.
+    Partitioned indexes and filters, cache_index_and_filter_blocks and the
+    pinning of the L0 blocks are not exposed by aimrocks.
+    """
+    table = {}
+    if block_cache_size == 0:
+        table["no_block_cache"] = True
+    elif block_cache_size is not None:
+        table["block_cache"] = aimrocks.LRUCache(block_cache_size)
+    if bloom_bits > 0:
+        table["filter_policy"] = aimrocks.BloomFilterPolicy(bloom_bits)
+    return table
+
+
+def make_options(
+    compressor: tuple[aimrocks.CompressionType, int],
+    block_size: int,
+    create: bool = True,
+    insert_mode: str = "writebatch",
+    target_file_size: int = 64 * MiB,
+    table: dict = None,
+    dict_bytes: int = 0,
+    write_path: dict = None,
+) -> aimrocks.Options:
+    """
+    Build the options of a test db. `create` is True to create a new db and
+    False to open an existing one, `insert_mode` is one of INSERT_MODES and
+    `table` the block cache and filter made by table_options().
+
+    With `dict_bytes` > 0 every SST file is compressed with a dictionary of
+    up to that size, sampled by RocksDB from the data of the file itself.
+    aimrocks doesn't expose zstd_max_train_bytes, so the dictionary is the
+    raw samples rather than a trained zstd dictionary.
+
+    `write_path` is a profile of config.write_paths, a dict of
+    WRITE_PATH_OPTIONS; its options override the ones of the insert mode.
+    """
+    if insert_mode not in INSERT_MODES:
+        raise ValueError(f"Unknown insert mode {insert_mode}")
+    write_path = write_path or {}
+    check_write_path(write_path, insert_mode)
+    compr = compressor[0]
+    level = compressor[1]
+    opts = aimrocks.Options()
+    opts.create_if_missing = create
+    opts.error_if_exists = create
+    # options to make db faster
+    opts.allow_mmap_reads = True
+    opts.paranoid_checks = False
+    opts.use_adaptive_mutex = True
+    # compression and block
+    opts.compression = compr
+    compression_opts = {}
+    if level != 0:
+        compression_opts["level"] = level
+    if dict_bytes > 0:
+        compression_opts["max_dict_bytes"] = dict_bytes
+    if compression_opts:
+        opts.compression_opts = compression_opts
+    opts.table_factory = aimrocks.BlockBasedTableFactory(
+        block_size=block_size, **(table or {})
+    )
+    if insert_mode == "ingest":
+        # one memtable becomes one SST file of the target size, and files
+        # pile up in L0 without stalling the writes until the final compaction
+        opts.disable_auto_compactions = True
+        opts.write_buffer_size = target_file_size
+        opts.target_file_size_base = target_file_size
+        opts.level0_slowdown_writes_trigger = 1 << 20
+        opts.level0_stop_writes_trigger = 1 << 20
+    for name, value in write_path.items():
+        if name == "max_background_jobs":
+            flushes = max(1, value // 4)
+            opts.max_background_flushes = flushes
+            opts.max_background_compactions = max(1, value - flushes)
+        elif name not in ("sync", "disable_wal"):
+            setattr(opts, name, value)
+    return opts
+
+
+def check_write_path(write_path: dict, insert_mode: str = "writebatch"):
+    # reject the profiles that RocksDB would fail on at the first write
+    for name in write_path:
+        if name not in WRITE_PATH_OPTIONS:
+            raise ValueError(f"Unknown write path option {name}")
+    no_wal = insert_mode == "ingest" or write_path.get("disable_wal")
+    if write_path.get("sync") and no_wal:
+        raise ValueError("Sync writes need the WAL, drop sync or disable_wal")
+
+
+def write_options(insert_mode: str, write_path: dict = None) -> dict:
+    # keyword arguments of DB.write for the insert mode and write path
+    write_path = write_path or {}
+    return {
+        "sync": write_path.get("sync", False),
+        "disable_wal": insert_mode == "ingest" or write_path.get("disable_wal", False),
+    }
+
+
+def finish_insert(db: aimrocks.DB, insert_mode: str, write_path: dict = None):
+    # every insert mode ends with the memtables on disk (without the WAL
+    # that's the only copy), so that all of them are timed to the same point;
+    # with no automatic compactions a manual one moves the L0 files down
+    write_path = write_path or {}
+    db.flush()
+    if insert_mode == "ingest" or write_path.get("disable_auto_compactions"):
+        db.compact_range()
+
+
+# background work of RocksDB that must be over before measuring a db
+BACKGROUND_PROPERTIES = [
+    b"rocksdb.mem-table-flush-pending",
+    b"rocksdb.num-running-flushes",
+    b"rocksdb.compaction-pending",
+    b"rocksdb.num-running-compactions",
+]
+
+
+def settle(db: aimrocks.DB, full_compaction: bool = False, poll: float = 0.05):
+    """
+    Wait until RocksDB has no flushes or compactions pending or running, so
+    that the db is measured once the compactions triggered by the inserts
+    are over. With `full_compaction`, the memtables are flushed and all the
+    db is compacted first.
+    """
+    if full_compaction:
+        db.flush()
+        db.compact_range()
+    while any(int(db.get_property(p) or 0) for p in BACKGROUND_PROPERTIES):
+        time.sleep(poll)
+
+
+def compaction_stats(db: aimrocks.DB) -> dict:
+    """
+    Bytes written by the flushes and read and written by the compactions
+    since the db was opened, parsed from rocksdb.stats. aimrocks has no
+    statistics object, and rocksdb.stats has these in GiB with 2-3
+    decimals, so small dbs read as 0.
+    """
+    text = (db.get_property(b"rocksdb.stats") or b"").decode()
+    stats = {"flush_bytes": 0, "compaction_write_bytes": 0, "compaction_read_bytes": 0}
+    flush = re.search(r"Flush\(GB\): cumulative ([\d.]+)", text)
+    if flush:
+        stats["flush_bytes"] = int(float(flush.group(1)) * GiB)
+    compaction = re.search(
+        r"Cumulative compaction: ([\d.]+) GB write, [\d.]+ MB/s write, ([\d.]+) GB read",
+        text,
+    )
+    if compaction:
+        stats["compaction_write_bytes"] = int(float(compaction.group(1)) * GiB)
+        stats["compaction_read_bytes"] = int(float(compaction.group(2)) * GiB)
+    return stats
+
+
+def level_stats(db: aimrocks.DB) -> list[tuple[int, int]]:
+    # number of SST files and their bytes at every level of the LSM tree
+    sizes = {}
+    for f in db.get_live_files_metadata():
+        sizes[f["level"]] = sizes.get(f["level"], 0) + f["size"]
+    levels = []
+    while True:
+        files = db.get_property(b"rocksdb.num-files-at-level%d" % len(levels))
+        if files is None:
+            return levels
+        levels.append((int(files), sizes.get(len(levels), 0)))
+
+
+def levels_str(levels: list[tuple[int, int]]) -> str:
+    # "L<level>:<files>/<MiB>" of the levels with files, for the CSV
+    return " ".join(
+        f"L{level}:{files}/{round(size / MiB, 2)}"
+        for level, (files, size) in enumerate(levels)
+        if files
+    )
+
+
+def table_properties(db: aimrocks.DB) -> dict:
+    """
+    Parse rocksdb.aggregated-table-properties, the properties of all the SST
+    files of the db summed up ("data block size", "index block size (...)",
+    "raw key size", "# entries"...), into a dict of numbers.
+    """
+    props = {}
+    text = db.get_property(b"rocksdb.aggregated-table-properties") or b""
+    for field in text.decode().split("; "):
+        name, sep, value = field.rpartition("=")
+        if not sep:
+            continue
+        try:
+            props[name] = float(value) if "." in value else int(value)
+        except ValueError:
+            props[name] = value
+    return props
+
+
+def block_cache_usage(db: aimrocks.DB) -> tuple[int, int]:
+    # bytes in the block cache, and the ones pinned by open iterators and
+    # tables. aimrocks has no statistics, so there are no hit/miss counters
+    usage = db.get_property(b"rocksdb.block-cache-usage")
+    pinned = db.get_property(b"rocksdb.block-cache-pinned-usage")
+    return int(usage or 0), int(pinned or 0)
+
+
+def index_block_size(props: dict) -> int:
+    # the name of the index size also says how the index is encoded
+    return next(
+        (value for name, value in props.items() if name.startswith("index block size")),
+        0,
+    )
+
+
+def recompress(db_path: str, opts: aimrocks.Options) -> aimrocks.DB:
+    """
+    Reopen the db at `db_path` with `opts`, then compact all of it, forcing
+    the bottommost level too: every SST file is rewritten with the
+    compression of `opts`. aimrocks has no compression_per_level nor
+    bottommost_compression, so this is how a db is loaded with a fast
+    compressor and stored with a slow one. Returns the reopened db.
+
+    The caller must drop its handle of the db first (del, not close(): an
+    aimrocks DB closed by hand crashes when it is garbage collected).
+    """
+    db = aimrocks.DB(db_path, opts, read_only=False)
+    db.compact_range(bottommost_level_compaction="force")
+    return db
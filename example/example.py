@@ -8,7 +8,7 @@ import aimrocks
 import lib, os
 
 KiB = 1024
-MiB = 1024 * 1024 * 1024
+MiB = 1024 * 1024
 
 
 def main() :
@@ -28,32 +28,36 @@ def main() :
     parquet_file = pq.ParquetFile(parquet_path)
     max_size = 1 * MiB
     keys_to_get = []
+    shas_to_get = []
 
-    # Test insertion
-    ins_time = 0
+    # Test insertion, with the puts buffered by a bulk writer
     tot_size = 0
-    for batch in parquet_file.iter_batches(
-        columns=[
-            'hexsha',
-            'max_stars_repo_path',
-            'content',
-            'size',
-            'lang',
-        ]
-    ):
-        batch_list = batch.to_pylist()
-        for row in batch_list:
-            key = db.make_key(
-                row['hexsha'], row['max_stars_repo_path'], int(row['size']), max_size
-            )
-            start = time.time()
-            db.insert_single(key.encode(), row['content'].encode())
-            end = time.time()
-            ins_time += end - start
-            tot_size += int(row['size'])
-            # save 10% of keys for retrieval
-            if random.random() < 0.1:
-                keys_to_get.append(key.encode())
+    start = time.time()
+    with db.bulk_writer(disable_wal=True) as writer:
+        for batch in parquet_file.iter_batches(
+            columns=[
+                'hexsha',
+                'max_stars_repo_path',
+                'content',
+                'size',
+                'lang',
+            ]
+        ):
+            batch_list = batch.to_pylist()
+            for row in batch_list:
+                key = db.make_key(
+                    row['hexsha'], row['max_stars_repo_path'], int(row['size']), max_size
+                )
+                key = db.encode_key(key, max_size)
+                writer.put(key, row['content'].encode())
+                tot_size += int(row['size'])
+                # save 10% of keys for retrieval
+                if random.random() < 0.1:
+                    keys_to_get.append(key)
+                    shas_to_get.append(row['hexsha'])
+    end = time.time()
+    ins_time = end - start
+    print('Bulk writer:', writer.stats())
     print(f'Insertion throughput: {round(tot_size / MiB / ins_time, 2)} MiB/s')
 
     print('Getting', len(keys_to_get))
@@ -76,5 +80,27 @@ def main() :
     mg_time = end - start
     print(f'Multi-get throughput: {round(got_size / MiB / mg_time, 2)} MiB/s')
 
+    # Test multi-get with the keys sorted, to read the keys of a block together
+    start = time.time()
+    values = db.multi_get(keys_to_get, sort=True)
+    end = time.time()
+    print(f'Sorted multi-get throughput: {round(got_size / MiB / (end - start), 2)} MiB/s')
+
+    # Test gets by sha, through the sha index
+    start = time.time()
+    for sha in shas_to_get:
+        value = db.get_by_sha(sha)
+    end = time.time()
+    print(f'Get-by-sha throughput: {round(got_size / MiB / (end - start), 2)} MiB/s')
+    start = time.time()
+    values = db.multi_get_by_sha(shas_to_get)
+    end = time.time()
+    print(f'Multi-get-by-sha throughput: {round(got_size / MiB / (end - start), 2)} MiB/s')
+
+    # Latency percentiles measured by the library
+    for op, stats in db.stats().items():
+        if stats['count'] > 0:
+            print(f"{op}: {stats['count']} calls, {stats.get('percentiles_us')} us")
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
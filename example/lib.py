@@ -1,8 +1,197 @@
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+
 import aimrocks
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import tlsh
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import instrumentation
+import keys
+
 KiB = 1024
-MiB = 1024 * 1024 * 1024
+MiB = 1024 * 1024
+
+# keys read by every multi get of multi_get() and iter_multi_get()
+MULTI_GET_CHUNK = 10000
+
+# column family of the secondary index, from the raw sha of every blob to its key
+SHA_CF = b"sha"
+
+
+def sha_cf_options() -> aimrocks.ColumnFamilyOptions:
+    """
+    Options of the sha index: small blocks and a bloom filter, since it is
+    only used for point lookups of 20 bytes keys.
+    """
+    copts = aimrocks.ColumnFamilyOptions()
+    copts.table_factory = aimrocks.BlockBasedTableFactory(
+        block_size=4 * KiB,
+        filter_policy=aimrocks.BloomFilterPolicy(10),
+    )
+    return copts
+
+
+def sha_from_key(key: bytes, binary=False) -> bytes:
+    """
+    Extracts the raw sha from a key, which always ends with -<hex sha>, or
+    with the raw sha for binary keys.
+
+    Args:
+        key (bytes): The key of the blob.
+        binary (bool, optional): Whether the key is binary. Defaults to False.
+
+    Returns:
+        bytes: The 20 bytes of the sha.
+    """
+    if binary:
+        return key[-20:]
+    return bytes.fromhex(key.rsplit(b"-", 1)[1].decode())
+
+
+def binary_key(key: str, max_size: int) -> bytes:
+    """
+    Converts a key made by make_key() to the binary encoding of keys.py: the
+    ordering prefix and "_", then the size as a big-endian integer of the
+    bytes needed by max_size and the raw sha. The keys are about 25 bytes
+    shorter and sort as the text ones, except between prefixes where one
+    extends the other with "_" (see keys.build_keys).
+
+    Args:
+        key (str): The key, as <prefix>_<size>-<hex sha>.
+        max_size (int): The maximum size of the files.
+
+    Returns:
+        bytes: The binary key.
+    """
+    head, sha = key.rsplit("-", 1)
+    prefix, size = head.rsplit("_", 1)
+    width = max(1, (max_size.bit_length() + 7) // 8)
+    return (
+        prefix.encode() + b"_" + int(size).to_bytes(width, "big") + bytes.fromhex(sha)
+    )
+
+
+class _Stopped(Exception):
+    # another stage of ingest_parquet() failed
+    pass
+
+
+def _put(q: queue.Queue, item, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+    raise _Stopped()
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    raise _Stopped()
+
+
+class BulkWriter:
+    def __init__(
+        self,
+        db_ppc: "DB_PPC",
+        max_bytes=64 * MiB,
+        max_ops=100000,
+        disable_wal=False,
+    ):
+        """
+        Accumulates puts in a WriteBatch, reused across writes, and writes it
+        when it holds max_bytes of keys and values or max_ops puts. Use it as a
+        context manager, the last puts are written on exit.
+
+        Args:
+            db_ppc (DB_PPC): The open database to write to.
+            max_bytes (int, optional): Bytes of keys and values that trigger a write. Defaults to 64 MiB.
+            max_ops (int, optional): Number of puts that trigger a write. Defaults to 100000.
+            disable_wal (bool, optional): Skip the write-ahead log, for bulk loads that can be redone from scratch. The memtables are flushed on exit. Defaults to False.
+        """
+        self.db_ppc = db_ppc
+        self.max_bytes = max_bytes
+        self.max_ops = max_ops
+        self.disable_wal = disable_wal
+        self.batch = aimrocks.WriteBatch()
+        self.batch_bytes = 0
+        self.batch_ops = 0
+        # counters of all the puts, see stats()
+        self.bytes = 0
+        self.ops = 0
+        self.timer = db_ppc.timers["bulk_flush"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Writes the last puts, and flushes the memtables if the WAL is disabled.
+        """
+        self.flush()
+        if self.disable_wal:
+            self.db_ppc.db.flush()
+
+    def put(self, key: bytes, value: bytes):
+        """
+        Adds a key-value pair (and its sha to the sha index) to the batch, and
+        writes the batch if it is full.
+
+        Args:
+            key (bytes): The key to insert.
+            value (bytes): The value to insert.
+        """
+        self.batch.put(key, value)
+        if self.db_ppc.sha_cf is not None:
+            sha = sha_from_key(key, self.db_ppc.key_encoding == "binary")
+            self.batch.put(sha, key, self.db_ppc.sha_cf)
+        self.batch_bytes += len(key) + len(value)
+        self.batch_ops += 1
+        if self.batch_bytes >= self.max_bytes or self.batch_ops >= self.max_ops:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the puts accumulated so far.
+        """
+        if self.batch_ops == 0:
+            return
+        with self.timer:
+            self.db_ppc.db.write(self.batch, disable_wal=self.disable_wal)
+        self.bytes += self.batch_bytes
+        self.ops += self.batch_ops
+        self.batch.clear()
+        self.batch_bytes = 0
+        self.batch_ops = 0
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the writer.
+
+        Returns:
+            dict: The bytes and the puts written, the number of writes and the seconds spent writing.
+        """
+        return {
+            "bytes": self.bytes,
+            "ops": self.ops,
+            "flushes": self.timer.count,
+            "flush_seconds": round(self.timer.seconds, 6),
+        }
 
 
 class DB_PPC:
@@ -15,6 +204,19 @@ class DB_PPC:
         """
         self.db_path = path
         self.db = None
+        self.sha_cf = None
+        self.key_encoding = "text"
+        # latency of every operation, see stats()
+        self.timers = {
+            "insert_single": instrumentation.Timer(hist=True),
+            "insert_batch": instrumentation.Timer(hist=True),
+            "bulk_flush": instrumentation.Timer(hist=True),
+            "single_get": instrumentation.Timer(hist=True),
+            "multi_get": instrumentation.Timer(hist=True),
+            "delete_key": instrumentation.Timer(hist=True),
+            "get_by_sha": instrumentation.Timer(hist=True),
+            "multi_get_by_sha": instrumentation.Timer(hist=True),
+        }
 
     def create_db(
         self,
@@ -22,6 +224,8 @@ class DB_PPC:
         compr=aimrocks.CompressionType.zlib_compression,
         compr_level=6,
         order="ext-filename-nopath",
+        sha_index=True,
+        key_encoding="text",
     ):
         """
         Create a new database with the given options.
@@ -31,11 +235,15 @@ class DB_PPC:
             compr (aimrocks.CompressionType, optional): The compression type to use. Defaults to aimrocks.CompressionType.zlib_compression.
             compr_level (int, optional): The compression level to use. Defaults to 6.
             order (str): The order of the elements to use. Defaults to ext-filename-nopath.
+            sha_index (bool, optional): Whether to keep the sha -> key index used by get_by_sha(). Defaults to True.
+            key_encoding (str, optional): How the keys are encoded, "text" or "binary" (see encode_key()). Defaults to text.
         """
         if order not in ["rev-filename", "ext-filename-nopath", "tlsh"]:
             raise Exception(
                 'Order must be either "rev-filename", "ext-filename-nopath", "tlsh"'
             )
+        if key_encoding not in keys.KEY_ENCODINGS:
+            raise Exception('Key encoding must be either "text" or "binary"')
         opts = aimrocks.Options()
         opts.create_if_missing = True
         opts.error_if_exists = True
@@ -49,6 +257,9 @@ class DB_PPC:
         opts.table_factory = aimrocks.BlockBasedTableFactory(block_size=block_size)
         self.db = aimrocks.DB(self.db_path, opts, read_only=False)
         self.order = order
+        self.key_encoding = key_encoding
+        if sha_index:
+            self.sha_cf = self.db.create_column_family(SHA_CF, sha_cf_options())
 
     def open_db(
         self,
@@ -56,20 +267,25 @@ class DB_PPC:
         compr=aimrocks.CompressionType.zlib_compression,
         compr_level=6,
         order="ext-filename-nopath",
+        key_encoding="text",
     ):
         """
-        Open an existing database with the given options.
+        Open an existing database with the given options. The sha index is
+        opened too if the database has one.
 
         Args:
             block_size (int, optional): The size of the blocks in the database. Defaults to 16 KiB.
             compr (aimrocks.CompressionType, optional): The compression type to use. Defaults to aimrocks.CompressionType.zlib_compression.
             compr_level (int, optional): The compression level to use. Defaults to 6.
             order (str): The order of the elements to use. Defaults to ext-filename-nopath.
+            key_encoding (str, optional): How the keys are encoded, "text" or "binary" (see encode_key()). Defaults to text.
         """
         if order not in ["rev-filename", "ext-filename-nopath", "tlsh"]:
             raise Exception(
                 'Order must be either "rev-filename", "ext-filename-nopath", "tlsh"'
             )
+        if key_encoding not in keys.KEY_ENCODINGS:
+            raise Exception('Key encoding must be either "text" or "binary"')
         opts = aimrocks.Options()
         opts.create_if_missing = False
         opts.error_if_exists = False
@@ -81,12 +297,20 @@ class DB_PPC:
         if compr_level != 0:
             opts.compression_opts = {"level": compr_level}
         opts.table_factory = aimrocks.BlockBasedTableFactory(block_size=block_size)
-        self.db = aimrocks.DB(self.db_path, opts, read_only=False)
+        column_families = {}
+        if SHA_CF in aimrocks.list_column_families(self.db_path, aimrocks.Options()):
+            column_families[SHA_CF] = sha_cf_options()
+        self.db = aimrocks.DB(
+            self.db_path, opts, column_families=column_families, read_only=False
+        )
         self.order = order
+        self.key_encoding = key_encoding
+        self.sha_cf = self.db.get_column_family(SHA_CF)
 
     def insert_single(self, key: bytes, value: bytes):
         """
-        Inserts a single key-value pair into the database.
+        Inserts a single key-value pair into the database, and its sha in the
+        sha index in the same write.
 
         Args:
             key (bytes): The key to insert.
@@ -97,7 +321,15 @@ class DB_PPC:
         """
         if not self.db:
             raise Exception("Database is not open")
-        self.db.put(key, value)
+        with self.timers["insert_single"]:
+            if self.sha_cf is None:
+                self.db.put(key, value)
+            else:
+                batch_write = aimrocks.WriteBatch()
+                batch_write.put(key, value)
+                sha = sha_from_key(key, self.key_encoding == "binary")
+                batch_write.put(sha, key, self.sha_cf)
+                self.db.write(batch_write)
 
     def insert_batch(self, keyvalue_pairs: dict[bytes, bytes]):
         """
@@ -114,7 +346,165 @@ class DB_PPC:
         batch_write = aimrocks.WriteBatch()
         for key, value in keyvalue_pairs.items():
             batch_write.put(key, value)
-        self.db.write(batch_write)
+            if self.sha_cf is not None:
+                sha = sha_from_key(key, self.key_encoding == "binary")
+                batch_write.put(sha, key, self.sha_cf)
+        with self.timers["insert_batch"]:
+            self.db.write(batch_write)
+
+    def bulk_writer(self, max_bytes=64 * MiB, max_ops=100000, disable_wal=False):
+        """
+        Returns a BulkWriter on the database, to load many key-value pairs much
+        faster than with insert_single().
+
+        Args:
+            max_bytes (int, optional): Bytes of keys and values that trigger a write. Defaults to 64 MiB.
+            max_ops (int, optional): Number of puts that trigger a write. Defaults to 100000.
+            disable_wal (bool, optional): Skip the write-ahead log. Defaults to False.
+
+        Returns:
+            BulkWriter: The writer, to use as a context manager.
+
+        Raises:
+            Exception: If the database is not open.
+        """
+        if not self.db:
+            raise Exception("Database is not open")
+        return BulkWriter(self, max_bytes, max_ops, disable_wal)
+
+    def ingest_parquet(
+        self,
+        path: str,
+        max_size: int = None,
+        batch_rows=10000,
+        queue_size=4,
+        max_bytes=64 * MiB,
+        disable_wal=True,
+    ) -> dict:
+        """
+        Loads a parquet file of the stack (hexsha, max_stars_repo_path, content,
+        size) into the database with three stages running at the same time,
+        connected by queues of at most queue_size batches: a thread decoding
+        the parquet, a thread building the keys and the calling thread writing
+        them with a BulkWriter.
+
+        Args:
+            path (str): Path of the parquet file.
+            max_size (int, optional): The maximum size for zero-padding the size in the keys. Defaults to the maximum size in the file.
+            batch_rows (int, optional): Rows of every batch going through the stages. Defaults to 10000.
+            queue_size (int, optional): Batches that can wait between two stages. Defaults to 4.
+            max_bytes (int, optional): Bytes of every write of the BulkWriter. Defaults to 64 MiB.
+            disable_wal (bool, optional): Skip the write-ahead log. Defaults to True.
+
+        Returns:
+            dict: The rows and bytes loaded, the seconds and MiB/s, the stats of the BulkWriter and, for every stage, the seconds it was busy and its utilization (busy time over the whole load). The stage close to 1 is the bottleneck.
+
+        Raises:
+            Exception: If the database is not open, or the error of any stage.
+        """
+        if not self.db:
+            raise Exception("Database is not open")
+        parquet_file = pq.ParquetFile(path)
+        if max_size is None:
+            max_size = pc.max(parquet_file.read(columns=["size"])["size"]).as_py()
+        columns = ["hexsha", "max_stars_repo_path", "content", "size"]
+        batches = queue.Queue(queue_size)
+        pairs = queue.Queue(queue_size)
+        stop = threading.Event()
+        errors = []
+        busy = {
+            "read": instrumentation.Timer(),
+            "keys": instrumentation.Timer(),
+            "write": instrumentation.Timer(),
+        }
+
+        def read():
+            it = parquet_file.iter_batches(batch_size=batch_rows, columns=columns)
+            while True:
+                with busy["read"]:
+                    batch = next(it, None)
+                _put(batches, batch, stop)
+                if batch is None:
+                    return
+
+        def make_keys():
+            while (batch := _get(batches, stop)) is not None:
+                with busy["keys"]:
+                    values = pc.cast(batch["content"], pa.large_binary())
+                    if self.order == "tlsh":
+                        # the fingerprint is computed on the content, row by row
+                        batch_keys = [
+                            self.encode_key(
+                                self.make_key(sha, filepath, size, max_size, content),
+                                max_size,
+                            )
+                            for sha, filepath, size, content in zip(
+                                batch["hexsha"].to_pylist(),
+                                batch["max_stars_repo_path"].to_pylist(),
+                                batch["size"].to_pylist(),
+                                batch["content"].to_pylist(),
+                            )
+                        ]
+                    else:
+                        # same keys of make_key(), on whole columns
+                        batch = batch.rename_columns(
+                            ["hexsha", "filename", "content", "size"]
+                        )
+                        batch_keys = keys.build_keys(
+                            batch, self.order, 0, max_size, 0, self.key_encoding
+                        )
+                        batch_keys = pc.cast(batch_keys, pa.large_binary()).to_pylist()
+                    values = values.to_pylist()
+                _put(pairs, (batch_keys, values), stop)
+            _put(pairs, None, stop)
+
+        def run(stage):
+            try:
+                stage()
+            except _Stopped:
+                pass
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+        start = time.perf_counter()
+        threads = [
+            threading.Thread(target=run, args=(stage,), daemon=True)
+            for stage in (read, make_keys)
+        ]
+        for thread in threads:
+            thread.start()
+        writer = self.bulk_writer(max_bytes=max_bytes, disable_wal=disable_wal)
+        try:
+            while (item := _get(pairs, stop)) is not None:
+                with busy["write"]:
+                    for key, value in zip(*item):
+                        writer.put(key, value)
+            with busy["write"]:
+                writer.close()
+        except _Stopped:
+            pass
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        seconds = time.perf_counter() - start
+        return {
+            "rows": writer.ops,
+            "bytes": writer.bytes,
+            "seconds": round(seconds, 6),
+            "mib_s": round(writer.bytes / MiB / seconds, 2),
+            "writer": writer.stats(),
+            "stages": {
+                name: {
+                    "busy_seconds": round(timer.seconds, 6),
+                    "utilization": round(timer.seconds / seconds, 3),
+                }
+                for name, timer in busy.items()
+            },
+        }
 
     def single_get(self, key: bytes) -> bytes:
         """
@@ -124,7 +514,7 @@ class DB_PPC:
             key (bytes): The key to look up in the database.
 
         Returns:
-            bytes: The value associated with the key, decoded as a UTF-8 string.
+            bytes: The value associated with the key, as stored.
                    Returns None if the key does not exist in the database.
 
         Raises:
@@ -132,29 +522,70 @@ class DB_PPC:
         """
         if not self.db:
             raise Exception("Database is not open")
-        value = self.db.get(key)
-        return value.decode("utf-8") if value else None
+        with self.timers["single_get"]:
+            return self.db.get(key)
 
-    def multi_get(self, keys: list[bytes]) -> list[bytes]:
+    def multi_get(
+        self,
+        keys: list[bytes],
+        as_dict=False,
+        sort=False,
+        chunk_size=MULTI_GET_CHUNK,
+    ) -> list[bytes] | dict[bytes, bytes]:
         """
-        Retrieve multiple values from the database for the given list of keys.
+        Retrieve multiple values from the database for the given list of keys,
+        with a multi get every chunk_size keys.
 
         Args:
             keys (list[bytes]): A list of keys to retrieve values for.
+            as_dict (bool, optional): Return a dict from key to value instead of a list. Defaults to False.
+            sort (bool, optional): Sort the keys of every chunk before reading them, so that keys in the same block are read together. Defaults to False.
+            chunk_size (int, optional): The number of keys of every multi get. Defaults to MULTI_GET_CHUNK.
 
         Returns:
-            list[bytes]: A list of values corresponding to the provided keys.
+            list[bytes]: The values in the same order of keys, None for the keys not in the database.
+                         If as_dict is True, a dict from every key to its value.
+
+        Raises:
+            Exception: If the database is not open.
+        """
+        pairs = self.iter_multi_get(keys, sort=sort, chunk_size=chunk_size)
+        if as_dict:
+            return dict(pairs)
+        return [value for _, value in pairs]
+
+    def iter_multi_get(self, keys, sort=False, chunk_size=MULTI_GET_CHUNK):
+        """
+        Same as multi_get(), but yields the (key, value) pairs as every chunk is
+        read, so keys can be any iterable (e.g. a generator of millions of keys)
+        and only a chunk of values is in memory at a time.
+
+        Args:
+            keys (Iterable[bytes]): The keys to retrieve values for.
+            sort (bool, optional): Sort the keys of every chunk before reading them. Defaults to False.
+            chunk_size (int, optional): The number of keys of every multi get. Defaults to MULTI_GET_CHUNK.
+
+        Yields:
+            tuple[bytes, bytes]: Every key with its value (None if the key is not in the database), in the same order of keys.
 
         Raises:
             Exception: If the database is not open.
         """
         if not self.db:
             raise Exception("Database is not open")
-        self.db.multi_get(keys)
+        keys = iter(keys)
+        while chunk := list(itertools.islice(keys, chunk_size)):
+            # multi_get() of aimrocks returns a dict, so the order of the
+            # chunk is restored by looking up every key
+            to_read = sorted(set(chunk)) if sort else chunk
+            with self.timers["multi_get"]:
+                values = self.db.multi_get(to_read)
+            for key in chunk:
+                yield key, values[key]
 
     def delete_key(self, key: bytes):
         """
-        Deletes a key-value pair from the database.
+        Deletes a key-value pair from the database, and its sha from the sha index.
 
         Args:
             key (bytes): The key to be deleted from the database.
@@ -164,7 +595,120 @@ class DB_PPC:
         """
         if self.db is None:
             raise Exception("Database is not open")
-        self.db.delete(key)
+        with self.timers["delete_key"]:
+            if self.sha_cf is None:
+                self.db.delete(key)
+            else:
+                batch_write = aimrocks.WriteBatch()
+                batch_write.delete(key)
+                sha = sha_from_key(key, self.key_encoding == "binary")
+                batch_write.delete(sha, self.sha_cf)
+                self.db.write(batch_write)
+
+    def get_by_sha(self, sha: str) -> bytes:
+        """
+        Retrieve a blob given only its sha, through the sha index.
+
+        Args:
+            sha (str): The hex SHA of the blob.
+
+        Returns:
+            bytes: The value of the blob, or None if the sha is not in the database.
+
+        Raises:
+            Exception: If the database is not open or has no sha index.
+        """
+        if self.sha_cf is None:
+            raise Exception("Database is not open or has no sha index")
+        with self.timers["get_by_sha"]:
+            key = self.db.get(bytes.fromhex(sha), self.sha_cf)
+            return self.db.get(key) if key is not None else None
+
+    def multi_get_by_sha(self, shas: list[str]) -> list[bytes]:
+        """
+        Retrieve multiple blobs given their shas, with one multi get on the sha
+        index and one on the blobs.
+
+        Args:
+            shas (list[str]): The hex SHAs of the blobs.
+
+        Returns:
+            list[bytes]: The values in the same order of shas, None for the shas not in the database.
+
+        Raises:
+            Exception: If the database is not open or has no sha index.
+        """
+        if self.sha_cf is None:
+            raise Exception("Database is not open or has no sha index")
+        with self.timers["multi_get_by_sha"]:
+            index_keys = [(self.sha_cf, bytes.fromhex(sha)) for sha in shas]
+            keys = self.db.multi_get(index_keys)
+            found = [key for key in keys.values() if key is not None]
+            values = self.db.multi_get(found)
+            return [
+                values[keys[index_key]] if keys[index_key] is not None else None
+                for index_key in index_keys
+            ]
+
+    def build_sha_index(self, batch_size=10000):
+        """
+        Builds the sha index of a database created without it, scanning all
+        its keys.
+
+        Args:
+            batch_size (int, optional): Number of index entries written at a time. Defaults to 10000.
+
+        Raises:
+            Exception: If the database is not open.
+        """
+        if self.db is None:
+            raise Exception("Database is not open")
+        if self.sha_cf is None:
+            self.sha_cf = self.db.create_column_family(SHA_CF, sha_cf_options())
+        batch_write = aimrocks.WriteBatch()
+        it = self.db.iterkeys()
+        it.seek_to_first()
+        for key in it:
+            sha = sha_from_key(key, self.key_encoding == "binary")
+            batch_write.put(sha, key, self.sha_cf)
+            if batch_write.count() >= batch_size:
+                self.db.write(batch_write)
+                batch_write.clear()
+        self.db.write(batch_write)
+
+    def stats(self) -> dict:
+        """
+        Returns the timings of the operations made on the database so far.
+
+        Returns:
+            dict: For every operation, the total time in seconds, the number of calls, the mean latency and the latency percentiles in microseconds.
+                  Multi gets are counted once per chunk of keys.
+        """
+        return instrumentation.to_json(self.timers)
+
+    def export_stats(self, path: str):
+        """
+        Writes the timings returned by stats() to a JSON file.
+
+        Args:
+            path (str): Path of the JSON file.
+        """
+        instrumentation.export_json(path, self.stats())
+
+    def encode_key(self, key: str, max_size: int) -> bytes:
+        """
+        Encodes a key made by make_key() as the keys of the database.
+
+        Args:
+            key (str): The key.
+            max_size (int): The maximum size, the same given to make_key().
+
+        Returns:
+            bytes: The key encoded as UTF-8, or as binary_key() if the key encoding of the database is binary.
+        """
+        if self.key_encoding == "binary":
+            return binary_key(key, max_size)
+        return key.encode()
 
     def make_key(
         self, sha: str, filepath: str, size: int, max_size: int, content: str = None
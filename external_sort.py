@@ -0,0 +1,155 @@
+import bisect
+import heapq
+import os
+import resource
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+
+KiB = 1024
+MiB = 1024 * 1024
+GiB = 1024 * 1024 * 1024
+
+# rows per record batch in the run files, i.e. how much of every run is
+# looked at during the merge
+merge_batch_rows = 4096
+
+
+def write_run(table: pa.Table, path: str):
+    # sort a table on its "key" column and write it as a run file
+    table = table.take(pc.sort_indices(table["key"]))
+    with ipc.new_file(path, table.schema) as writer:
+        writer.write_table(table, max_chunksize=merge_batch_rows)
+
+
+class RunWriter:
+    """
+    Accumulates record batches with a "key" column and spills them to disk as
+    sorted runs (Arrow IPC files) every time `run_size` bytes are buffered,
+    so memory stays bounded whatever the size of the input.
+    """
+
+    def __init__(self, run_dir: str, run_size: int):
+        self.run_dir = run_dir
+        self.run_size = run_size
+        self.run_paths = []
+        self.spill_bytes = 0
+        self.pending = []
+        self.pending_bytes = 0
+        os.makedirs(run_dir, exist_ok=True)
+
+    def add(self, batch: pa.RecordBatch):
+        if batch.num_rows == 0:
+            return
+        self.pending.append(batch)
+        self.pending_bytes += batch.nbytes
+        if self.pending_bytes >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        if not self.pending:
+            return
+        path = f"{self.run_dir}/run-{len(self.run_paths)}.arrow"
+        write_run(pa.Table.from_batches(self.pending), path)
+        self.run_paths.append(path)
+        self.spill_bytes += os.path.getsize(path)
+        self.pending = []
+        self.pending_bytes = 0
+
+    def finish(self) -> list[str]:
+        self.spill()
+        return self.run_paths
+
+
+class _RunCursor:
+    # position inside a sorted run, one record batch of it in memory at once
+    def __init__(self, path: str):
+        self.reader = ipc.open_file(pa.memory_map(path))
+        self.n_batch = 0
+        self.batch = None
+        self.keys = []
+        self.pos = 0
+
+    def load(self) -> bool:
+        while self.n_batch < self.reader.num_record_batches:
+            self.batch = self.reader.get_batch(self.n_batch)
+            self.n_batch += 1
+            if self.batch.num_rows > 0:
+                self.keys = self.batch["key"].to_pylist()
+                self.pos = 0
+                return True
+        return False
+
+
+def merge_runs(run_paths: list[str], batch_rows: int):
+    """
+    k-way merge of sorted runs on their "key" column. Instead of moving single
+    rows, every step emits the longest slice of a run whose keys all come
+    before the smallest key of the other runs; slices are zero-copy and are
+    yielded grouped in tables of about `batch_rows` rows.
+    """
+    cursors = [_RunCursor(path) for path in run_paths]
+    # runs without any row are left out of the heap
+    heap = [(c.keys[0], i) for i, c in enumerate(cursors) if c.load()]
+    heapq.heapify(heap)
+    slices = []
+    n_rows = 0
+    while heap:
+        _, i = heapq.heappop(heap)
+        cursor = cursors[i]
+        if heap:
+            end = bisect.bisect_right(cursor.keys, heap[0][0], lo=cursor.pos)
+        else:
+            end = len(cursor.keys)
+        slices.append(cursor.batch.slice(cursor.pos, end - cursor.pos))
+        n_rows += end - cursor.pos
+        cursor.pos = end
+        if cursor.pos < len(cursor.keys) or cursor.load():
+            heapq.heappush(heap, (cursor.keys[cursor.pos], i))
+        if n_rows >= batch_rows:
+            yield pa.Table.from_batches(slices)
+            slices = []
+            n_rows = 0
+    if slices:
+        yield pa.Table.from_batches(slices)
+
+
+def reset_peak_rss():
+    # restart the peak of peak_rss() from the current resident set size, so
+    # that every test of a sweep process measures its own peak (Linux only)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _proc_status(field: str) -> int:
+    # a size in /proc/self/status (in KiB), in bytes; None without /proc
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * KiB
+    except OSError:
+        pass
+    return None
+
+
+def rss() -> int:
+    # resident set size of this process, in bytes
+    current = _proc_status("VmRSS")
+    return peak_rss() if current is None else current
+
+
+def peak_rss() -> int:
+    """
+    Peak resident set size of this process, in bytes, since the last
+    reset_peak_rss(). Without /proc it falls back to ru_maxrss, the peak of
+    the whole life of the process (Linux reports it in KiB).
+    """
+    peak = _proc_status("VmHWM")
+    if peak is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * KiB
+    return peak
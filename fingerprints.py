@@ -0,0 +1,210 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tlsh
+
+import contents_store
+
+KiB = 1024
+MiB = 1024 * 1024
+GiB = 1024 * 1024 * 1024
+
+
+def create_tlsh(content) -> str:
+    if type(content) != str:
+        content = content.decode("latin-1")
+    fingerprint = "0"
+    # don't compute hash for strings bigger than 1 MiB (keep "0")
+    if len(content) > 1 * MiB:
+        return fingerprint
+    if len(content) > 50:  # requested by tlsh algorithm
+        # first 8 bytes are metadata
+        try:
+            fingerprint = tlsh.hash(str.encode(content))[8:]
+        except Exception as e:
+            print(f"ERROR IN CREATE_FINGERPRINTS: {e}")
+    return fingerprint
+
+
+def fingerprint_contents(contents: pa.Array):
+    # runs inside a worker: fingerprint a whole column of contents and time it,
+    # so that the parent can report the throughput of every single worker
+    start = time.time()
+    fingerprints = [create_tlsh(content) for content in contents.to_pylist()]
+    end = time.time()
+    return fingerprints, os.getpid(), contents.nbytes, end - start
+
+
+class FingerprintCache:
+    """
+    On-disk sidecar of the fingerprints already computed, as a Parquet file of
+    (hexsha, tlsh) rows sorted by hexsha. The hexsha identifies the content,
+    so a fingerprint never needs to be computed twice across runs.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.new_shas = []
+        self.new_tlsh = []
+        self.shas, self.tlsh = self._load()
+
+    def _load(self):
+        # the (hexsha, tlsh) columns of the sidecar, empty if it doesn't exist
+        if not os.path.exists(self.path):
+            return np.empty(0, dtype="S40"), pa.array([], type=pa.large_string())
+        table = pq.read_table(self.path, columns=["hexsha", "tlsh"])
+        shas = contents_store.hexsha_array(table["hexsha"])
+        return shas, table["tlsh"].cast(pa.large_string()).combine_chunks()
+
+    def __len__(self):
+        return len(self.shas)
+
+    def lookup(self, shas: pa.Array):
+        # returns the fingerprints (None if missing) and the indices of misses
+        fingerprints = [None] * len(shas)
+        if len(self.shas) == 0:
+            misses = np.arange(len(shas))
+        else:
+            query = contents_store.hexsha_array(shas)
+            pos = np.searchsorted(self.shas, query)
+            pos[pos == len(self.shas)] = 0
+            found = self.shas[pos] == query
+            hits = np.flatnonzero(found)
+            misses = np.flatnonzero(~found)
+            cached = self.tlsh.take(pa.array(pos[hits])).to_pylist()
+            for i, fingerprint in zip(hits, cached):
+                fingerprints[i] = fingerprint
+        self.hits += len(shas) - len(misses)
+        self.misses += len(misses)
+        return fingerprints, misses
+
+    def add(self, shas: pa.Array, fingerprints: list[str]):
+        self.new_shas.append(shas)
+        self.new_tlsh.append(pa.array(fingerprints, type=pa.large_string()))
+
+    def hit_rate(self) -> str:
+        tot = self.hits + self.misses
+        rate = round(self.hits * 100 / tot, 2) if tot != 0 else 0
+        return f"{self.hits}/{tot} hits ({rate}%)"
+
+    def save(self):
+        # merge the new fingerprints into the sorted sidecar and replace it.
+        # Other processes (e.g. parallel sweep workers) may have saved the same
+        # sidecar in the meantime, so merge with what is on disk now and write
+        # through a per-process temporary file
+        if not self.new_shas:
+            return
+        disk_shas, disk_tlsh = self._load()
+        shas = np.concatenate(
+            [disk_shas, self.shas]
+            + [contents_store.hexsha_array(s) for s in self.new_shas]
+        )
+        tlsh_arr = pa.concat_arrays([disk_tlsh, self.tlsh] + self.new_tlsh)
+        order = np.argsort(shas, kind="stable")
+        shas = shas[order]
+        unique = np.ones(len(shas), dtype=bool)
+        unique[1:] = shas[1:] != shas[:-1]
+        order = order[unique]
+        table = pa.table(
+            {
+                "hexsha": contents_store.hexsha_to_arrow(shas[unique]),
+                "tlsh": tlsh_arr.take(pa.array(order)),
+            }
+        )
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, self.path)
+        self.shas = shas[unique]
+        self.tlsh = table["tlsh"].combine_chunks()
+        self.new_shas = []
+        self.new_tlsh = []
+
+
+def iter_fingerprints(
+    batches,
+    column: str,
+    workers: int,
+    worker_stats: dict,
+    cache: FingerprintCache = None,
+    sha_column: str = "hexsha",
+):
+    """
+    Compute the TLSH fingerprints of the contents in `column` for every record
+    batch, fanning the batches out to a pool of `workers` processes.
+
+    Yields (batch, fingerprints) tuples in the same order of `batches`. The
+    number of batches in flight is bounded, so memory doesn't grow with the
+    size of the dataset. `worker_stats` is filled with
+    { pid: [bytes, seconds] } for every worker that took part.
+
+    If a `cache` is given, it is consulted first using `sha_column` and only
+    the contents missing from it are hashed; their fingerprints are added to
+    the cache, which is then saved to disk.
+    """
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    max_pending = 2 * workers
+    pending = deque()
+    try:
+        for batch in batches:
+            if cache is not None:
+                fingerprints, misses = cache.lookup(batch.column(sha_column))
+            else:
+                fingerprints, misses = [None] * batch.num_rows, None
+            if misses is None:
+                contents = batch.column(column)
+            elif len(misses) > 0:
+                contents = batch.column(column).take(pa.array(misses))
+            else:
+                contents = None  # everything was in the cache
+            if contents is None:
+                result = None
+            elif pool is None:
+                result = fingerprint_contents(contents)
+            else:
+                result = pool.submit(fingerprint_contents, contents)
+            pending.append((batch, fingerprints, misses, result))
+            if len(pending) >= max_pending or pool is None:
+                yield _collect(pending.popleft(), worker_stats, cache, sha_column)
+        while pending:
+            yield _collect(pending.popleft(), worker_stats, cache, sha_column)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    if cache is not None:
+        cache.save()
+
+
+def _collect(item, worker_stats: dict, cache: FingerprintCache, sha_column: str):
+    batch, fingerprints, misses, result = item
+    if result is None:
+        return batch, fingerprints
+    if not isinstance(result, tuple):
+        result = result.result()
+    computed, pid, nbytes, elapsed = result
+    stats = worker_stats.setdefault(pid, [0, 0])
+    stats[0] += nbytes
+    stats[1] += elapsed
+    if misses is None:
+        return batch, computed
+    for i, fingerprint in zip(misses, computed):
+        fingerprints[i] = fingerprint
+    cache.add(batch.column(sha_column).take(pa.array(misses)), computed)
+    return batch, fingerprints
+
+
+def worker_throughput(worker_stats: dict) -> str:
+    thrs = [
+        round(nbytes / MiB / elapsed, 2) if elapsed > 0 else 0
+        for nbytes, elapsed in worker_stats.values()
+    ]
+    if not thrs:
+        return "no workers"
+    avg_thr = round(sum(thrs) / len(thrs), 2)
+    return f"{len(thrs)} workers, {avg_thr} MiB/s per worker {thrs}"
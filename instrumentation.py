@@ -0,0 +1,187 @@
+import json
+import time
+from contextlib import contextmanager
+
+KiB = 1024
+MiB = 1024 * 1024
+GiB = 1024 * 1024 * 1024
+
+# HDR-style histogram: values below 2^(SUB_BITS+1) get a bucket each, above that
+# every power of two is split in 2^SUB_BITS buckets, so the error of any
+# recorded value is below 1/2^SUB_BITS (~0.8%) whatever its magnitude
+SUB_BITS = 7
+SUB_BUCKETS = 1 << SUB_BITS
+
+
+def _bucket(value: int) -> int:
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def _bucket_value(bucket: int) -> int:
+    # middle of the range of values of the bucket
+    if bucket < 2 * SUB_BUCKETS:
+        return bucket
+    shift = bucket // SUB_BUCKETS - 1
+    mantissa = bucket - shift * SUB_BUCKETS
+    return (mantissa << shift) + (1 << (shift - 1))
+
+
+class LatencyHistogram:
+    """
+    Log-bucketed histogram of latencies in nanoseconds. Recording a value
+    costs a few integer operations and the memory used doesn't depend on the
+    number of values; histograms of different threads or processes are
+    combined with merge().
+    """
+
+    def __init__(self):
+        self.counts = [0] * (66 * SUB_BUCKETS)
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, ns: int):
+        self.counts[_bucket(ns)] += 1
+        self.total += 1
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if ns > self.max:
+            self.max = ns
+
+    def merge(self, other: "LatencyHistogram"):
+        for i, count in enumerate(other.counts):
+            if count:
+                self.counts[i] += count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p: float) -> int:
+        # value (ns) below which there are p% of the recorded values
+        if self.total == 0:
+            return 0
+        rank = max(1, round(p * self.total / 100))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(max(_bucket_value(i), self.min), self.max)
+        return self.max
+
+    def mean(self) -> float:
+        if self.total == 0:
+            return 0
+        return (
+            sum(
+                _bucket_value(i) * count for i, count in enumerate(self.counts) if count
+            )
+            / self.total
+        )
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)) -> dict:
+        # percentiles in microseconds, rounded for the CSV
+        return {f"p{p:g}": round(self.percentile(p) / 1000, 2) for p in percentiles}
+
+
+class Timer:
+    """
+    Accumulates the time of many operations with perf_counter_ns, which has
+    nanosecond resolution and a much smaller overhead than time.time(). If
+    `hist` is True, every operation is also recorded in a LatencyHistogram.
+
+    Use it as a context manager around an operation, or call add() with the
+    nanoseconds measured by hand in the hottest loops.
+    """
+
+    def __init__(self, hist: bool = False):
+        self.ns = 0
+        self.count = 0
+        self.hist = LatencyHistogram() if hist else None
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.add(time.perf_counter_ns() - self._start)
+
+    def add(self, ns: int):
+        self.ns += ns
+        self.count += 1
+        if self.hist is not None:
+            self.hist.record(ns)
+
+    @property
+    def seconds(self) -> float:
+        return self.ns / 1e9
+
+    def to_dict(self) -> dict:
+        d = {
+            "seconds": round(self.seconds, 6),
+            "count": self.count,
+            "mean_us": round(self.ns / self.count / 1000, 3) if self.count else 0,
+        }
+        if self.hist is not None:
+            d["percentiles_us"] = self.hist.summary()
+            d["max_us"] = round(self.hist.max / 1000, 3)
+        return d
+
+
+class Spans:
+    """
+    Wall-clock spans of the phases of a run (read parquet, sort, insert,
+    compaction, queries...), each with its start from the creation of the
+    Spans object, its length and any extra attribute given.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter_ns()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter_ns(), **attrs)
+
+    def add(self, name: str, start: int, end: int, **attrs):
+        # record a span measured by hand with perf_counter_ns
+        self.spans.append(
+            {
+                "name": name,
+                "start_s": round((start - self.origin) / 1e9, 6),
+                "seconds": round((end - start) / 1e9, 6),
+                **attrs,
+            }
+        )
+
+    def seconds(self, name: str) -> float:
+        # total time spent in the spans called `name`
+        return sum(span["seconds"] for span in self.spans if span["name"] == name)
+
+    def to_dict(self) -> list:
+        return list(self.spans)
+
+
+def to_json(obj):
+    # make timers, spans and histograms JSON serializable
+    if isinstance(obj, (Timer, Spans)):
+        return obj.to_dict()
+    if isinstance(obj, LatencyHistogram):
+        return obj.summary()
+    if isinstance(obj, dict):
+        return {str(k): to_json(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json(v) for v in obj]
+    return obj
+
+
+def export_json(path: str, data: dict):
+    with open(path, "w") as f:
+        json.dump(to_json(data), f, indent=4)
@@ -0,0 +1,201 @@
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import contents_store
+
+# every key is computed on whole Arrow columns with pyarrow.compute kernels,
+# the result is the same as building it row by row with Python strings
+
+_SPLIT_EXT = r"(?s)^(?P<stem>.*)\.(?P<ext>[^.]*)$"
+_SPLIT_PATH = r"(?s)^(?:(?P<path>.*)/)?(?P<name>[^/]*)$"
+
+
+def _str(column):
+    # same as calling str() on every value, None included
+    return pc.fill_null(pc.cast(column, pa.large_string()), "None")
+
+
+def _hexsha(column):
+    # shas may be kept as raw 20-byte digests to save memory
+    if column.type == pa.binary(20):
+        return contents_store.bin_to_hexsha(column)
+    return _str(column)
+
+
+def _join(*parts):
+    parts = [
+        pa.scalar(part, pa.large_string()) if isinstance(part, str) else part
+        for part in parts
+    ]
+    return pc.binary_join_element_wise(*parts, pa.scalar("", pa.large_string()))
+
+
+def _ext_first(names):
+    # given file.ext return ext.file, names without a dot are left untouched
+    split = pc.extract_regex(names, _SPLIT_EXT)
+    stem = pc.struct_field(split, "stem")
+    ext = pc.struct_field(split, "ext")
+    return pc.if_else(pc.is_valid(split), _join(ext, ".", stem), names)
+
+
+def reverse_filename_tosoni_nopath(paths):
+    # given path/to/file.cpp, return cpp.file
+    split = pc.extract_regex(paths, _SPLIT_PATH)
+    return _ext_first(pc.struct_field(split, "name"))
+
+
+def reverse_filename_tosoni(paths):
+    # given path/to/file.cpp, return cpp.file/ot/htap
+    split = pc.extract_regex(paths, _SPLIT_PATH)
+    name = _ext_first(pc.struct_field(split, "name"))
+    path = pc.utf8_reverse(pc.struct_field(split, "path"))
+    return pc.if_else(pc.equal(path, ""), name, _join(name, "/", path))
+
+
+def _be_bytes(column, width: int):
+    # unsigned integers as big-endian binaries of `width` bytes, which sort
+    # byte by byte as the numbers do
+    values = np.asarray(pc.fill_null(pc.cast(column, pa.uint64()), 0), dtype=">u8")
+    digits = np.ascontiguousarray(values.view(np.uint8).reshape(-1, 8)[:, 8 - width :])
+    return pa.FixedSizeBinaryArray.from_buffers(
+        pa.binary(width), len(digits), [None, pa.py_buffer(digits)]
+    )
+
+
+def _sha_bin(column):
+    if column.type == pa.binary(20):
+        return column
+    return contents_store.bin_to_arrow(contents_store.hexsha_to_bin(column))
+
+
+def _byte_width(max_value: int) -> int:
+    return max(1, (max_value.bit_length() + 7) // 8)
+
+
+# how the keys are encoded:
+#   "text" is prefix_size-sha, with the size in zero-padded decimal digits
+#       and the sha in hexadecimal (prefix-sha for the orders with no size)
+#   "binary" is prefix_ followed by the size as a big-endian integer of fixed
+#       width and the raw 20 bytes of the sha (prefix-sha as binary for the
+#       orders with no size). It is about 25 bytes shorter per key.
+KEY_ENCODINGS = ["text", "binary"]
+
+
+def build_keys(
+    table,
+    order: str,
+    index_len: int,
+    max_size: int,
+    first_index=0,
+    encoding: str = "text",
+):
+    """
+    Build the keys of all the rows of `table` (a pyarrow Table or
+    RecordBatch with the columns hexsha, filename, size, lang, tlsh and repo
+    as needed by the order). hexsha can be either hex strings or raw 20-byte
+    digests. `first_index` is the position of the first row
+    in the dataset, used by the "parquet" order.
+
+    Returns a large_string array with a key for every row, or a large_binary
+    array with the "binary" `encoding` (see KEY_ENCODINGS). The two encodings
+    don't always sort the keys the same way: when a prefix starts with
+    another prefix followed by "_" (or "-"), the rest of the longer prefix is
+    compared with the digits of the size in one and with its bytes in the
+    other. No terminator of the prefix fixes this, as the text order itself
+    depends on how the digits compare with the characters of the prefixes.
+    """
+    # every order is a prefix, a number (size or position) or both, and the sha
+    prefix = None
+    number = None
+    max_number = max_size
+    match order:
+        case "parquet":
+            number = pa.array(np.arange(first_index, first_index + table.num_rows))
+            max_number = 10**index_len - 1
+        case "rev-filename":
+            prefix = pc.utf8_reverse(_str(table["filename"]))
+            number = table["size"]
+        case "ext-filename":
+            prefix = reverse_filename_tosoni(_str(table["filename"]))
+            number = table["size"]
+        case "ext-filename-nopath":
+            prefix = reverse_filename_tosoni_nopath(_str(table["filename"]))
+            number = table["size"]
+        case "lang-ext-filename":
+            filename = reverse_filename_tosoni(_str(table["filename"]))
+            prefix = _join(_str(table["lang"]), "-", filename)
+        case "filename_repo":
+            filename = pc.utf8_reverse(_str(table["filename"]))
+            prefix = _join(filename, "_", _str(table["repo"]))
+        case "repo_filename":
+            filename = pc.utf8_reverse(_str(table["filename"]))
+            prefix = _join(_str(table["repo"]), "_", filename)
+        case "tlsh":
+            prefix = _str(table["tlsh"])
+            number = table["size"]
+        case _:
+            raise ValueError(f"Unknown order {order}")
+    match encoding:
+        case "text":
+            sha = _hexsha(table["hexsha"])
+            parts = []
+            if prefix is not None:
+                parts += [prefix, "_"] if number is not None else [prefix]
+            if number is not None:
+                width = len(str(max_number))
+                parts.append(pc.utf8_lpad(_str(number), width, "0"))
+            return _join(*parts, "-", sha)
+        case "binary":
+            parts = []
+            if prefix is not None:
+                parts.append(pc.cast(prefix, pa.large_binary()))
+                parts.append(b"_" if number is not None else b"-")
+            if number is not None:
+                parts.append(_be_bytes(number, _byte_width(max_number)))
+            parts.append(_sha_bin(table["hexsha"]))
+            parts = [
+                (
+                    pa.scalar(part, pa.large_binary())
+                    if isinstance(part, bytes)
+                    else pc.cast(part, pa.large_binary())
+                )
+                for part in parts
+            ]
+            return pc.binary_join_element_wise(
+                *parts, pa.scalar(b"", pa.large_binary())
+            )
+    raise ValueError(f"Unknown key encoding {encoding}")
+
+
+def _is_sorted(keys) -> bool:
+    if len(keys) < 2:
+        return True
+    return pc.all(pc.less_equal(keys[:-1], keys[1:])).as_py()
+
+
+def sort_permutation(keys, cache_path: str = None) -> np.ndarray:
+    """
+    Return the permutation that sorts `keys`. Arrow compares strings byte by
+    byte, exactly as RocksDB's default comparator does, so this is the order
+    the keys will have in the db.
+
+    If `cache_path` is given the permutation is saved there as a .npy file,
+    and loaded from it next time instead of sorting again, as long as it
+    has one entry per key and still sorts them: a permutation of other keys
+    (changed dataset or key building) is computed again.
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        permutation = np.load(cache_path, mmap_mode="r")
+        if len(permutation) == len(keys) and _is_sorted(keys.take(permutation)):
+            return permutation
+    permutation = pc.sort_indices(keys).to_numpy()
+    if cache_path is not None:
+        # write and rename, so concurrent tests never see a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, permutation)
+        os.replace(tmp_path, cache_path)
+    return permutation
@@ -0,0 +1,231 @@
+import json
+import multiprocessing
+import threading
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from instrumentation import LatencyHistogram
+
+KiB = 1024
+MiB = 1024 * 1024
+GiB = 1024 * 1024 * 1024
+
+DISTRIBUTIONS = ["uniform", "zipf", "insert-order", "replay"]
+CSV_HEADER = "READ_DISTRIBUTION,READ_THREADS,READ_OPS/s,READ_THROUGHPUT(MiB/s),READ_P50(us),READ_P90(us),READ_P99(us),READ_P999(us)"
+
+
+def make_workload(
+    keys: pa.Array,
+    distribution: str,
+    n_ops: int,
+    zipf_s: float = 1.1,
+    replay_path: str = None,
+    seed: int = None,
+    hex_keys: bool = False,
+) -> list[bytes]:
+    """
+    Build the list of keys to read, given the keys in the db in insertion
+    order:
+    - "uniform": every key has the same probability of being read
+    - "zipf": a few keys (chosen at random) take most of the reads, with
+      exponent `zipf_s` (> 1)
+    - "insert-order": the keys are read in the same order they were inserted
+    - "replay": the keys are read from `replay_path`, a JSON list of keys as
+      written by the query log of the benchmarks (in hexadecimal if
+      `hex_keys`, as the logs of binary keys)
+    """
+    rng = np.random.default_rng(seed)
+    match distribution:
+        case "uniform":
+            index = rng.integers(len(keys), size=n_ops)
+        case "zipf":
+            # zipf ranks start from 1 and are unbounded, fold them on the keys
+            ranks = (rng.zipf(zipf_s, size=n_ops) - 1) % len(keys)
+            index = rng.permutation(len(keys))[ranks]
+        case "insert-order":
+            index = np.arange(n_ops) % len(keys)
+        case "replay":
+            decode = bytes.fromhex if hex_keys else str.encode
+            with open(replay_path) as f:
+                return [decode(key) for key in json.load(f)]
+        case _:
+            raise ValueError(f"Unknown read distribution {distribution}")
+    return pc.cast(keys.take(pa.array(index)), pa.large_binary()).to_pylist()
+
+
+def csv_fields(distribution: str, threads: int, processes: int, result: dict):
+    # fields of the READ_* columns of the benchmarks (CSV_HEADER)
+    if result is None:
+        return "none,0,0,0,0,0,0,0"
+    p = result["hist"].summary()
+    return (
+        f"{distribution},{threads * processes},{result['ops_s']},{result['mib_s']},"
+        f"{p['p50']},{p['p90']},{p['p99']},{p['p99.9']}"
+    )
+
+
+def _reader(db, workload: list[bytes], hist: LatencyHistogram, stats: list):
+    got_size = 0
+    found = 0
+    for key in workload:
+        start = time.perf_counter_ns()
+        got = db.get(key)
+        end = time.perf_counter_ns()
+        hist.record(end - start)
+        if got is not None:
+            got_size += len(got)
+            found += 1
+    stats.extend([got_size, found])
+
+
+def _run_threads(db, workload: list[bytes], threads: int):
+    # each thread reads a contiguous chunk of the workload; aimrocks releases
+    # the GIL in get(), so the threads really read from the db in parallel
+    chunks = np.array_split(np.arange(len(workload)), threads)
+    hists = [LatencyHistogram() for _ in chunks]
+    stats = [[] for _ in chunks]
+    workers = [
+        threading.Thread(
+            target=_reader,
+            args=(db, [workload[i] for i in chunk], hist, chunk_stats),
+        )
+        for chunk, hist, chunk_stats in zip(chunks, hists, stats)
+    ]
+    start = time.perf_counter_ns()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    end = time.perf_counter_ns()
+    hist = LatencyHistogram()
+    for h in hists:
+        hist.merge(h)
+    got_size = sum(s[0] for s in stats)
+    found = sum(s[1] for s in stats)
+    return hist, got_size, found, start, end
+
+
+def _run_process(open_db, workload: list[bytes], threads: int, conn):
+    db = open_db()
+    conn.send(_run_threads(db, workload, threads))
+    conn.close()
+
+
+def run(db, workload: list[bytes], threads: int, processes: int = 1, open_db=None):
+    """
+    Read all the keys of `workload` with `threads` threads and return a dict
+    with the latency histogram, the ops/s, the MiB/s and the keys found.
+
+    With more than one process, the workload is split among `processes`
+    forked processes with `threads` threads each; every process opens its
+    own handle of the db with `open_db()` (e.g. read only), as a RocksDB
+    handle can't be shared across a fork.
+    """
+    if processes <= 1:
+        hist, got_size, found, start, end = _run_threads(db, workload, threads)
+    else:
+        ctx = multiprocessing.get_context("fork")
+        chunks = np.array_split(np.arange(len(workload)), processes)
+        pipes = []
+        for chunk in chunks:
+            recv_conn, send_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(
+                target=_run_process,
+                args=(open_db, [workload[i] for i in chunk], threads, send_conn),
+            )
+            process.start()
+            send_conn.close()
+            pipes.append((recv_conn, process))
+        hist = LatencyHistogram()
+        got_size = found = 0
+        start = end = None
+        for recv_conn, process in pipes:
+            p_hist, p_got_size, p_found, p_start, p_end = recv_conn.recv()
+            process.join()
+            hist.merge(p_hist)
+            got_size += p_got_size
+            found += p_found
+            # perf_counter is system wide, so the times of the processes compare
+            start = p_start if start is None else min(start, p_start)
+            end = p_end if end is None else max(end, p_end)
+    elapsed = (end - start) / 1e9
+    return {
+        "hist": hist,
+        "found": found,
+        "ops_s": round(len(workload) / elapsed, 2) if elapsed > 0 else 0,
+        "mib_s": round(got_size / MiB / elapsed, 2) if elapsed > 0 else 0,
+    }
+
+
+def _open_loop_reader(
+    db, workload: list[bytes], arrivals: np.ndarray, hist: LatencyHistogram, stats
+):
+    # latency is measured from when the request should have been sent, so a
+    # slow db also counts the time requests wait for it (no coordinated
+    # omission)
+    got_size = 0
+    found = 0
+    late = 0
+    for key, arrival in zip(workload, arrivals.tolist()):
+        now = time.perf_counter_ns()
+        if now < arrival:
+            time.sleep((arrival - now) / 1e9)
+        else:
+            late += 1
+        got = db.get(key)
+        hist.record(time.perf_counter_ns() - arrival)
+        if got is not None:
+            got_size += len(got)
+            found += 1
+    stats.extend([got_size, found, late])
+
+
+def run_open_loop(
+    db, workload: list[bytes], rate: float, threads: int, poisson: bool = False
+):
+    """
+    Send the reads of `workload` at `rate` requests per second, whatever the
+    time the db takes to answer, using `threads` threads to have more
+    requests in flight. Arrivals are evenly spaced, or exponentially
+    distributed if `poisson` is True.
+
+    Returns the same dict of run(), plus the number of requests that were
+    sent late because all the threads were busy.
+    """
+    if poisson:
+        gaps = np.random.default_rng().exponential(1e9 / rate, size=len(workload))
+    else:
+        gaps = np.full(len(workload), 1e9 / rate)
+    start = time.perf_counter_ns()
+    arrivals = start + np.cumsum(gaps).astype(np.int64)
+    # request i goes to thread i % threads, so every thread gets its arrivals
+    # in order and they are spread evenly
+    hists = [LatencyHistogram() for _ in range(threads)]
+    stats = [[] for _ in range(threads)]
+    workers = [
+        threading.Thread(
+            target=_open_loop_reader,
+            args=(db, workload[t::threads], arrivals[t::threads], hists[t], stats[t]),
+        )
+        for t in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    end = time.perf_counter_ns()
+    hist = LatencyHistogram()
+    for h in hists:
+        hist.merge(h)
+    got_size = sum(s[0] for s in stats)
+    elapsed = (end - start) / 1e9
+    return {
+        "hist": hist,
+        "found": sum(s[1] for s in stats),
+        "late": sum(s[2] for s in stats),
+        "ops_s": round(len(workload) / elapsed, 2) if elapsed > 0 else 0,
+        "mib_s": round(got_size / MiB / elapsed, 2) if elapsed > 0 else 0,
+    }
@@ -0,0 +1,117 @@
+import argparse
+import json
+import time
+
+import aimrocks
+
+import config
+import db_options
+import instrumentation
+import read_load
+
+KiB = 1024
+MiB = 1024 * 1024
+GiB = 1024 * 1024 * 1024
+
+# replay a log of keys (or of shas) against a db built by the benchmarks, to
+# see how an order behaves under a realistic access pattern
+
+
+def load_key_log(path: str, hex_keys: bool = False) -> list[bytes]:
+    # a JSON list of keys, like the query logs of the benchmarks, or a text
+    # file with a key per line. Binary keys are logged in hexadecimal
+    decode = bytes.fromhex if hex_keys else str.encode
+    if path.endswith(".json"):
+        with open(path) as f:
+            return [decode(key) for key in json.load(f)]
+    with open(path) as f:
+        return [decode(line.strip()) for line in f if line.strip()]
+
+
+def map_shas(db: aimrocks.DB, shas: list[bytes], binary: bool = False) -> list[bytes]:
+    """
+    Map a log of hexshas to the keys of the db. Every key ends with -sha (or
+    with the raw sha if the keys are `binary`), so a scan of the keys is
+    enough; only the shas of the log are kept in memory. Shas not in the db
+    are dropped.
+    """
+    wanted = set(shas)
+    found = {}
+    it = db.iterkeys()
+    it.seek_to_first()
+    for key in it:
+        sha = key[-20:].hex().encode() if binary else key[-40:]
+        if sha in wanted:
+            found[sha] = key
+    return [found[sha] for sha in shas if sha in found]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a key log against a RocksDB built by the benchmarks"
+    )
+    parser.add_argument("db_path", help="path of the db (kept with keep_db = True)")
+    parser.add_argument(
+        "log_path", help="JSON list of keys or file with a key per line"
+    )
+    parser.add_argument(
+        "--shas", action="store_true", help="the log has shas instead of keys"
+    )
+    parser.add_argument(
+        "--hex",
+        action="store_true",
+        help="the db has binary keys (in hexadecimal in the log)",
+    )
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument(
+        "--processes", type=int, default=1, help="processes (closed loop only)"
+    )
+    parser.add_argument("--rate", type=float, default=1000, help="ops/s (open loop)")
+    parser.add_argument(
+        "--poisson", action="store_true", help="exponential arrivals (open loop)"
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="times to replay the log")
+    parser.add_argument("--json", help="export the results to this JSON file")
+    args = parser.parse_args()
+
+    print(f"Start replay at {time.asctime()}")
+    print(f"DB: {args.db_path}, log: {args.log_path}")
+
+    # compression and block size are read from the sst files
+    opts = db_options.make_options(
+        config.compressors[0], config.block_sizes[0], create=False
+    )
+    db = aimrocks.DB(args.db_path, opts, read_only=True)
+    if args.shas:
+        workload = load_key_log(args.log_path)
+        n_shas = len(workload)
+        workload = map_shas(db, workload, args.hex)
+        print(f"Mapped {len(workload)} out of {n_shas} shas to keys")
+    else:
+        workload = load_key_log(args.log_path, args.hex)
+    workload = workload * args.repeat
+    print(f"Replaying {len(workload)} requests, {args.mode} loop")
+
+    if args.mode == "closed":
+        open_db = lambda: aimrocks.DB(args.db_path, opts, read_only=True)
+        result = read_load.run(db, workload, args.threads, args.processes, open_db)
+    else:
+        result = read_load.run_open_loop(
+            db, workload, args.rate, args.threads, args.poisson
+        )
+    result["block_cache_usage"] = int(db.get_property(b"rocksdb.block-cache-usage"))
+
+    p = result["hist"].summary()
+    print("MODE,REQUESTS,FOUND,OPS/s,MiB/s,P50(us),P90(us),P99(us),P999(us)")
+    print(
+        f"{args.mode},{len(workload)},{result['found']},{result['ops_s']},"
+        f"{result['mib_s']},{p['p50']},{p['p90']},{p['p99']},{p['p99.9']}"
+    )
+    if args.mode == "open":
+        print(f"Requests sent late (all threads busy): {result['late']}")
+    print(f"Block cache usage: {round(result['block_cache_usage'] / MiB, 2)} MiB")
+    if args.json is not None:
+        instrumentation.export_json(args.json, {"args": vars(args), **result})
+        print(f"Results exported to {args.json}")
+    print(f"End replay at {time.asctime()}")
@@ -1,18 +1,22 @@
 import os
+import sys
 import time
 
 from pyarrow.parquet import ParquetFile
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import instrumentation
+
 parq_uncomp = "/disk2/federico/the-stack/the-stack-dedup_v1_uncomp_none.parquet"
 parq_compr = "/disk2/data/the-stack/the-stack-dedup_v1.parquet"
 
 if __name__ == "__main__":
     print(f"Starting at {time.asctime()}, pid: {os.getpid()}")
-    start_pf = time.time()
-    pf = ParquetFile(parq_uncomp)
-    end_pf = time.time()
-    print(f"Open uncomp parq file: {round(end_pf - start_pf)}")
-    start_read = time.time()
+    spans = instrumentation.Spans()
+    with spans.span("open uncomp"):
+        pf = ParquetFile(parq_uncomp)
+    print(f"Open uncomp parq file: {round(spans.seconds('open uncomp'))}")
+    start_read = time.perf_counter_ns()
     tot_uncomp_size = 0
     for batch in pf.iter_batches(
         columns=[
@@ -25,17 +29,16 @@ if __name__ == "__main__":
     ):
         df = batch.to_pandas()
         del df
-    end_read = time.time()
-    print(f"Read uncomp parq file {round(end_read - start_read)}")
+    spans.add("read uncomp", start_read, time.perf_counter_ns())
+    print(f"Read uncomp parq file {round(spans.seconds('read uncomp'))}")
 
     print(f"Half time: {time.asctime()}")
 
     del pf
-    start_pf = time.time()
-    pf = ParquetFile(parq_compr)
-    end_pf = time.time()
-    print(f"Open compr parq file: {round(end_pf - start_pf)}")
-    start_read = time.time()
+    with spans.span("open compr"):
+        pf = ParquetFile(parq_compr)
+    print(f"Open compr parq file: {round(spans.seconds('open compr'))}")
+    start_read = time.perf_counter_ns()
     tot_compr_size = 0
     for batch in pf.iter_batches(
         columns=[
@@ -48,7 +51,8 @@ if __name__ == "__main__":
     ):
         df = batch.to_pandas()
         del df
-    end_read = time.time()
-    print(f"Read compr parq file {round(end_read - start_read)}")
+    spans.add("read compr", start_read, time.perf_counter_ns())
+    print(f"Read compr parq file {round(spans.seconds('read compr'))}")
 
+    instrumentation.export_json(f"parquet_performance-{os.getpid()}.json", spans)
     print(f"Ending at {time.asctime()}")
@@ -3,6 +3,10 @@ import pandas as pd
 import aimrocks
 import time
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import instrumentation
 
 test_type = "get"  # put or get
 put_parquet_path = "/weka1/federico/the-stack/small/the-stack-10G.parquet"
@@ -39,7 +43,9 @@ def test_get():
     print(
         f"GET test, reading {len(df)} records taken from {get_parquet_path} from DBs in {dbs_path}, ordered by {ordered_by}"
     )
-    print("CONTENT_DB,SIZE(GiB),SG_THROUGHPUT(MiB/s),MG_THROUGHPUT(MiB/s)")
+    print(
+        "CONTENT_DB,SIZE(GiB),SG_THROUGHPUT(MiB/s),MG_THROUGHPUT(MiB/s),N_MGET,SG_P50(us),SG_P99(us),SG_P999(us)"
+    )
     nqueries = len(df)
     for content_db_path in get_db_paths:
         db_name = content_db_path.split("/")[-1]
@@ -76,8 +82,8 @@ def test_get():
         opts.table_factory = aimrocks.BlockBasedTableFactory(block_size=block_size)
         contents_db = aimrocks.DB(content_db_path, opts, read_only=True)
 
-        tot_sg_time = 0
-        tot_mg_time = 0
+        sg_timer = instrumentation.Timer(hist=True)
+        mg_timer = instrumentation.Timer(hist=True)
         tot_get_size = 0
         keys_mget = []
         found_sg = 0
@@ -93,31 +99,30 @@ def test_get():
                 filename = str(row["max_stars_repo_path"])
                 key = f"{filename}-{sha}"
             keys_mget.append(str.encode(key))
-            get_start = time.time()
+            get_start = time.perf_counter_ns()
             got = contents_db.get(str.encode(key))
-            get_end = time.time()
+            sg_timer.add(time.perf_counter_ns() - get_start)
             tot_get_size += len(got)
             found_sg += sum(x is not None for x in [got])
-            tot_sg_time += get_end - get_start
             if i % 100 == 0 or (i == len(df) - 1 and len(keys_mget) > 0):
-                get_start = time.time()
-                gotlist = contents_db.multi_get(keys_mget)
-                get_end = time.time()
-                tot_mg_time += get_end - get_start
+                with mg_timer:
+                    gotlist = contents_db.multi_get(keys_mget)
                 keys_mget.clear()
                 n_mget += 1
                 found_mg += sum(x is not None for x in gotlist)
         total_get_size_mb = tot_get_size / MiB
         print(
-            f"{round(total_get_size_mb / tot_sg_time, 3)},",
+            f"{round(total_get_size_mb / sg_timer.seconds, 3)},",
             end="",
         )
         if found_sg != nqueries:
             print(f"\nERROR: found {found_sg} out of {nqueries} queries")
         if not (found_sg == found_mg):
             print(f"\nERROR: found numbers differ: {found_sg}, {found_mg}")
+        sg_latency = sg_timer.hist.summary()
         print(
-            f"{round(total_get_size_mb / tot_mg_time, 3)},{n_mget} #mget",
+            f"{round(total_get_size_mb / mg_timer.seconds, 3)},{n_mget} #mget,"
+            f"{sg_latency['p50']},{sg_latency['p99']},{sg_latency['p99.9']}",
         )
 
 
@@ -166,7 +171,7 @@ def test_put():
 
             # for each in df, put in test_db
             tot_put_size = 0
-            tot_put_time = 0
+            put_timer = instrumentation.Timer()
             batch_write = aimrocks.WriteBatch()
             for i, row in df.iterrows():
                 sha = str(row["hexsha"])
@@ -177,26 +182,20 @@ def test_put():
                     filename = str(row["max_stars_repo_path"])
                     key = f"{filename}-{sha}"
                 tot_put_size += len(content)
-                put_start = time.time()
-                batch_write.put(str.encode(key), str.encode(content))
-                put_end = time.time()
-                tot_put_time += put_end - put_start
+                with put_timer:
+                    batch_write.put(str.encode(key), str.encode(content))
                 if i % 65536 == 0:  # like iter_batches
-                    put_start = time.time()
-                    test_db.write(batch_write)
-                    batch_write.clear()
-                    put_end = time.time()
-                    tot_put_time += put_end - put_start
+                    with put_timer:
+                        test_db.write(batch_write)
+                        batch_write.clear()
             # write the remainings of the batch
-            put_start = time.time()
-            test_db.write(batch_write)
-            put_end = time.time()
-            tot_put_time += put_end - put_start
+            with put_timer:
+                test_db.write(batch_write)
             tot_put_size_mb = tot_put_size / MiB
             print(f"{round(tot_put_size_mb)},", end="", flush=True)
-            print(f"{round(tot_put_time, 3)},", end="", flush=True)
-            print(f"{round(tot_put_time/len(df), 5)},", end="", flush=True)
-            print(f"{round(tot_put_size_mb/tot_put_time, 3)}", flush=True)
+            print(f"{round(put_timer.seconds, 3)},", end="", flush=True)
+            print(f"{round(put_timer.seconds/len(df), 5)},", end="", flush=True)
+            print(f"{round(tot_put_size_mb/put_timer.seconds, 3)}", flush=True)
 
             # delete the test_db
             # import shutil
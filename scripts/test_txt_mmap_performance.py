@@ -2,10 +2,14 @@ import json
 import mmap
 import os
 import random
+import sys
 import time
 
 from pyarrow.parquet import ParquetFile
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import instrumentation
+
 KiB = 1024
 MiB = 1024 * 1024
 GiB = 1024 * 1024 * 1024
@@ -32,7 +36,7 @@ if __name__ == "__main__":
         # print(f"Building the file {txt_size_str}")
         print(f"Building the file {txt_cont_path}")
         sha_sizes = {}  # made of { sha: (start_index, size) }
-        tot_put_time = 0
+        put_timer = instrumentation.Timer()
         with open(txt_cont_path, "a") as f:
             tot_size = 0
             pf = ParquetFile(parquet_path)
@@ -43,10 +47,8 @@ if __name__ == "__main__":
                     size = int(str(batch["size"][i]))
                     sha_sizes[sha] = (tot_size, size)
                     tot_size += size
-                    start_put = time.time()
-                    f.write(content)
-                    end_put = time.time()
-                    tot_put_time += end_put - start_put
+                    with put_timer:
+                        f.write(content)
                 #     if tot_size >= txt_size:
                 #         break
                 # if tot_size >= txt_size:
@@ -58,7 +60,7 @@ if __name__ == "__main__":
         with open(txt_cont_index, "w") as f:
             f.write(json.dumps(sha_sizes, indent=4))
         print(
-            f"Total time to write {round(tot_put_time, 3)} s, {round((tot_size / MiB) / tot_put_time, 3)} MiB/s"
+            f"Total time to write {round(put_timer.seconds, 3)} s, {round((tot_size / MiB) / put_timer.seconds, 3)} MiB/s"
         )
     else:
         print(f"File {txt_cont_path} already exists")
@@ -72,7 +74,7 @@ if __name__ == "__main__":
     print(f"Half-time {time.asctime()}")
 
     # test get with mmap
-    tot_get_time = 0
+    get_timer = instrumentation.Timer(hist=True)
     tot_get_size = 0
     shas = list(sha_sizes.keys())
     if get_calls < len(shas):
@@ -82,18 +84,18 @@ if __name__ == "__main__":
     with open(txt_cont_path, "r") as f:
         with mmap.mmap(f.fileno(), length=0, access=mmap.PROT_READ) as f_mmap:
             for sha in shas:
-                start_get = time.time()
+                start_get = time.perf_counter_ns()
                 coords = sha_sizes[sha]
                 start = coords[0]
                 length = coords[1]
                 f_mmap.seek(start)
                 content = f_mmap.read(length)
-                end_get = time.time()
-                tot_get_time += end_get - start_get
+                get_timer.add(time.perf_counter_ns() - start_get)
                 tot_get_size += length
 
-    print(f"Total time: {round(tot_get_time, 3)} s")
-    print(f"Time per get: {tot_get_time / len(shas)} s")
-    print(f"Throughput: {round((tot_get_size / MiB) / tot_get_time, 3)} MiB/s")
+    print(f"Total time: {round(get_timer.seconds, 3)} s")
+    print(f"Time per get: {get_timer.seconds / len(shas)} s")
+    print(f"Latency percentiles (us): {get_timer.hist.summary()}")
+    print(f"Throughput: {round((tot_get_size / MiB) / get_timer.seconds, 3)} MiB/s")
 
     print(f"Ending at {time.asctime()}")
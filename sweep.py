@@ -0,0 +1,214 @@
+import csv
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import traceback
+
+KiB = 1024
+MiB = 1024 * 1024
+GiB = 1024 * 1024 * 1024
+
+
+def max_workers(
+    requested: int, db_path: str, disk_per_test: int, mem_per_test: int
+) -> int:
+    """
+    Number of tests that can run at the same time: at most `requested`, one
+    per cpu, and as many as fit in the free disk space of `db_path` and in
+    the available memory given what every test needs.
+    """
+    cpus = os.cpu_count() or 1
+    free_disk = shutil.disk_usage(db_path).free
+    free_mem = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    workers = min(
+        requested,
+        cpus,
+        free_disk // max(disk_per_test, 1),
+        free_mem // max(mem_per_test, 1),
+    )
+    return max(int(workers), 1)
+
+
+class Ledger:
+    """
+    Durable record of the tests already completed, as a CSV file with the id
+    of every test, its metrics (JSON) and its CSV row. Every test is appended
+    and fsynced as soon as it is done, so a sweep that dies loses at most the
+    tests that were running, and a restarted sweep can skip the others.
+    """
+
+    def __init__(self, path: str, header: str):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, newline="") as f:
+                lines = f.readlines()
+            if next(csv.reader(lines[:1]), None) != ["TEST", "METRICS", header]:
+                raise Exception(
+                    f"{path} was written with different CSV columns, remove it"
+                )
+            size = len(lines[0].encode())
+            for n, line in enumerate(lines[1:], 2):
+                try:
+                    self._load_row(line)
+                except (ValueError, csv.Error):
+                    if n < len(lines):
+                        raise Exception(f"{path}:{n} is not a valid ledger row, fix it")
+                    # a sweep killed while appending leaves its last row torn:
+                    # cut it off, so that the next rows start on a line of their own
+                    print(f"WARNING: dropping the torn last row of {path}")
+                    os.truncate(path, size)
+                    break
+                size += len(line.encode())
+        else:
+            self._append(["TEST", "METRICS", header])
+
+    def _load_row(self, line: str):
+        # rows are only complete once their line ending is written
+        if not line.endswith("\n"):
+            raise ValueError("incomplete row")
+        test_id, test_metrics, row = next(csv.reader([line], strict=True))
+        self.done[test_id] = (row, json.loads(test_metrics))
+
+    def __contains__(self, test_id: str):
+        return test_id in self.done
+
+    def __getitem__(self, test_id: str) -> tuple[str, dict]:
+        return self.done[test_id]
+
+    def add(self, test_id: str, row: str, test_metrics: dict):
+        self._append([test_id, json.dumps(test_metrics), row])
+        self.done[test_id] = (row, test_metrics)
+
+    def _append(self, fields: list[str]):
+        with open(self.path, "a", newline="") as f:
+            csv.writer(f).writerow(fields)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def run_ledger(test, cells: list[dict], workers: int, ledger: Ledger, test_id):
+    """
+    Same as run(), but the cells whose `test_id(cell)` is in the `ledger` are
+    not tested again: their results are taken from the ledger. The results
+    of the new tests are added to it as soon as they are done, even if they
+    are yielded later, after the cells before them.
+    """
+    if ledger is None:
+        yield from run(test, cells, workers)
+        return
+    todo = [cell for cell in cells if test_id(cell) not in ledger]
+    done_before = {test_id(cell) for cell in cells} - {test_id(c) for c in todo}
+
+    def add(i, result):
+        ledger.add(test_id(todo[i]), *result)
+
+    new_results = run(test, todo, workers, add)
+    for cell in cells:
+        if test_id(cell) in done_before:
+            yield ledger[test_id(cell)]
+            continue
+        yield next(new_results)
+
+
+def _run_test(test, cell: dict, conn):
+    try:
+        conn.send((True, test(**cell)))
+    except BaseException:
+        conn.send((False, traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def run(test, cells: list[dict], workers: int, on_result=None):
+    """
+    Run `test(**cell)` for every cell of the grid and yield the results in the
+    same order of `cells`. If given, `on_result(i, result)` is called as soon
+    as the test of `cells[i]` is done, before the results of the cells
+    before it are yielded.
+
+    With more than one worker every test runs in a new forked process, so
+    `test` can hold anything (mmapped files, big tables) without pickling
+    it, nothing leaks from one test to the next and the tests are free to
+    start their own processes. Only the results go back through a pipe.
+    """
+    if workers <= 1:
+        for i, cell in enumerate(cells):
+            result = test(**cell)
+            if on_result is not None:
+                on_result(i, result)
+            yield result
+        return
+    ctx = multiprocessing.get_context("fork")
+    running = {}  # pipe -> (index of the cell, process)
+    done = {}
+    next_cell = 0
+    next_result = 0
+    try:
+        while next_result < len(cells):
+            while len(running) < workers and next_cell < len(cells):
+                recv_conn, send_conn = ctx.Pipe(duplex=False)
+                process = ctx.Process(
+                    target=_run_test, args=(test, cells[next_cell], send_conn)
+                )
+                process.start()
+                send_conn.close()
+                running[recv_conn] = (next_cell, process)
+                next_cell += 1
+            for conn in multiprocessing.connection.wait(list(running)):
+                i, process = running.pop(conn)
+                try:
+                    ok, result = conn.recv()
+                except EOFError:
+                    ok, result = False, "the test process died"
+                conn.close()
+                process.join()
+                if not ok:
+                    raise Exception(f"Test {cells[i]} failed:\n{result}")
+                done[i] = result
+                if on_result is not None:
+                    on_result(i, result)
+            while next_result in done:
+                yield done.pop(next_result)
+                next_result += 1
+    finally:
+        for _, process in running.values():
+            process.terminate()
+
+
+def baseline_deltas(
+    cells: list[dict], cell_metrics: list[dict], dim: str, baseline, names: list[str]
+) -> list[tuple[dict, dict]]:
+    """
+    Compare every cell whose `dim` is not `baseline` with the cell that only
+    differs from it in having `dim` equal to `baseline` (e.g. a dictionary
+    size against no dictionary). Returns, for every such cell, the cell and
+    a dict with the change (%) of every metric in `names`.
+    """
+
+    def others(cell):
+        return [(k, v) for k, v in cell.items() if k != dim]
+
+    base = {}
+    for cell, m in zip(cells, cell_metrics):
+        if cell[dim] == baseline:
+            base[repr(others(cell))] = m
+    deltas = []
+    for cell, m in zip(cells, cell_metrics):
+        b = base.get(repr(others(cell)))
+        if cell[dim] == baseline or b is None:
+            continue
+        deltas.append(
+            (
+                cell,
+                {
+                    name: (
+                        round((m[name] - b[name]) * 100 / b[name], 2) if b[name] else 0
+                    )
+                    for name in names
+                },
+            )
+        )
+    return deltas